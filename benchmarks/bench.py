@@ -0,0 +1,234 @@
+#!/usr/bin/python2
+#
+# Copyright 2019 Zacharier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A benchmark of `biu` itself. It generates a synthetic workspace, then times
+the phases of `Module.build` recorded by the profiler of `biu` in a cold, a
+no-op and an incremental run, and reports the results as JSON. The time of
+a phase excludes its nested phases, while 'total' is the whole build.
+
+eg: python2 benchmarks/bench.py --sources 2000 --headers 500 --output r.json
+"""
+
+import argparse
+import imp
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+biubiu = imp.load_source('biubiu', os.path.join(ROOT, 'biubiu.py'))
+
+
+class Workspace:
+    """
+    A synthetic workspace, headers are layered by `depth` and every source or
+    header includes `fanout` headers of the next layer.
+    """
+
+    def __init__(self, path, args, seed=0):
+        self._path = path
+        self._args = args
+        self._random = random.Random(seed)
+
+    def _layers(self):
+        args = self._args
+        per_layer = max(1, args.headers // max(1, args.depth))
+        names = ['h%d.h' % i for i in range(args.headers)]
+        return [names[i:i + per_layer]
+                for i in range(0, len(names), per_layer)]
+
+    def _write(self, fname, lines):
+        path = os.path.join(self._path, fname)
+        dirc = os.path.dirname(path)
+        if not os.path.exists(dirc):
+            os.makedirs(dirc)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+            f.write('\n')
+
+    def _includes(self, layer):
+        picked = self._random.sample(layer, min(len(layer), self._args.fanout))
+        return ['#include "%s"' % name for name in picked]
+
+    def generate(self, sub_modules=()):
+        args = self._args
+        layers = self._layers()
+        for i, layer in enumerate(layers):
+            for name in layer:
+                lines = ['#pragma once']
+                if i + 1 < len(layers):
+                    lines += self._includes(layers[i + 1])
+                self._write(os.path.join('include', name), lines)
+
+        artifacts = max(1, args.artifacts)
+        for i in range(args.sources):
+            lines = self._includes(layers[0]) if layers else []
+            lines.append('int f%d() { return %d; }' % (i, i))
+            self._write('src/a%d/s%d.cc' % (i % artifacts, i), lines)
+
+        build = ["CXXFLAGS('-O2')"]
+        for workspace, lib in sub_modules:
+            build.append("SUBMODULE('%s', '%s')" % (workspace, lib))
+        for i in range(artifacts):
+            build.append("LIBRARY('liba%d.a', includes=['include/'], "
+                         "sources=['src/a%d/*.cc'])" % (i, i))
+        self._write('BUILD', build)
+
+    def touch(self):
+        """
+        Change the content of a header of the deepest layer.
+        """
+        layers = self._layers()
+        if layers:
+            with open(os.path.join(self._path, 'include', layers[-1][0]),
+                      'a') as f:
+                f.write('// changed\n')
+
+
+# Maps the phases recorded by `biubiu.profiler` to the reported ones.
+PHASES = {
+    'BUILD': 'exec',
+    'globs': 'globs',
+    'protoc': 'protoc',
+    'fingerprint': 'fingerprint',
+    'prefetch': 'analyze',
+    'artifact': 'analyze',
+    'make': 'make',
+    'write': 'write',
+    'compdb': 'compdb',
+    'save': 'save',
+}
+
+
+def exclusive(events):
+    """
+    Return the time of each phase of `events` excluding the phases nested in
+    it, eg: 'make' excludes 'write', so no time is counted twice.
+    """
+    phases = {}
+    stack = []
+    for event in sorted(events, key=lambda event: (event['ts'],
+                                                   -event['dur'])):
+        while stack and event['ts'] >= stack[-1][0]:
+            stack.pop()
+        name = PHASES.get(event['name'])
+        if stack and stack[-1][1]:
+            phases[stack[-1][1]] -= event['dur']
+        if name:
+            phases[name] = phases.get(name, 0) + event['dur']
+        stack.append((event['ts'] + event['dur'], name))
+    return {name: dur / 1e6 for name, dur in phases.items()}
+
+
+def run_module(workspace, profiler):
+    """
+    Generate the Makefile of `workspace`, return the elapsed time of
+    `Module.build`.
+    """
+    module = biubiu.Module(workspace)
+    with profiler.phase('BUILD'):
+        execfile(os.path.join(workspace, 'BUILD'), biubiu.api(module))
+    start = time.time()
+    module.build('Makefile')
+    return time.time() - start
+
+
+def run(workspaces, runs):
+    # Silences the progress of `biu`.
+    say = biubiu.say
+    biubiu.say = lambda *args, **kwargs: None
+    profiler = biubiu.profiler
+    profiler.enable()
+    results = []
+    try:
+        for name, prepare in runs:
+            prepare()
+            biubiu.filesystem.reset()
+            total = sum(run_module(workspace, profiler)
+                        for workspace in workspaces)
+            phases = exclusive(profiler.take())
+            phases['total'] = total
+            phases = {key: round(val, 6) for key, val in phases.items()}
+            results.append({'run': name, 'phases': phases})
+    finally:
+        biubiu.say = say
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark of biu.')
+    parser.add_argument('--sources', type=int, default=1000)
+    parser.add_argument('--headers', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--artifacts', type=int, default=2)
+    parser.add_argument('--submodules', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report to a file')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the generated workspace')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='biubench-')
+    try:
+        workspaces = []
+        sub_modules = []
+        for i in range(args.submodules):
+            path = os.path.join(root, 'sub%d' % i)
+            Workspace(path, args, args.seed + i + 1).generate()
+            workspaces.append(path)
+            sub_modules.append((path, 'lib/liba0.a'))
+        major = Workspace(os.path.join(root, 'main'), args, args.seed)
+        major.generate(sub_modules)
+        # A module is generated after its submodules, like `biu` does.
+        workspaces.append(os.path.join(root, 'main'))
+
+        runs = [
+            ('cold', lambda: None),
+            ('noop', lambda: None),
+            ('incremental', major.touch),
+        ]
+        report = {
+            'version': biubiu.__version__,
+            'python': platform.python_version(),
+            'params': {key: val for key, val in vars(args).items()
+                       if key not in ('output', 'keep')},
+            'results': run(workspaces, runs),
+        }
+    finally:
+        if args.keep:
+            sys.stderr.write('workspace: %s\n' % root)
+        else:
+            shutil.rmtree(root, True)
+
+    content = json.dumps(report, indent=2, sort_keys=True,
+                         separators=(',', ': '))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        sys.stdout.write(content + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
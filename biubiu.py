@@ -23,13 +23,28 @@ In addition, which also supports to speed up the build process by `Ccache`.
 For detailed infomation of `Ccache` refer to: https://ccache.dev/
 """
 
-import commands
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
 import glob
+import hashlib
+import heapq
+import json
+import multiprocessing
 import os
 import re
+import select
 import shelve
 import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 __version__ = '1.0.0'
@@ -81,6 +96,130 @@ def break_str(prereqs):
     return ' \\\n\t'.join(prereqs)
 
 
+def update_file(fname, content):
+    """
+    Write `content` to `fname` unless it is unchanged, which keeps the mtime
+    of an unchanged file.
+    """
+    if os.path.exists(fname):
+        with open(fname) as f:
+            if f.read() == content:
+                return
+    dirc = os.path.dirname(fname)
+    if dirc and not os.path.exists(dirc):
+        os.makedirs(dirc)
+    with open(fname, 'w') as out:
+        out.write(content)
+
+
+class Profiler:
+    """
+    Record the wall and cpu time of nested phases along with the number of
+    file reads, stat calls and bytes scanned by each of them, the phases are
+    dumped as Chrome trace events.
+    """
+
+    counters = ('reads', 'stats', 'bytes')
+
+    def __init__(self):
+        self._enabled = False
+        self._counts = dict.fromkeys(self.counters, 0)
+        self._events = []
+
+    def enable(self):
+        self._enabled = True
+
+    def enabled(self):
+        return self._enabled
+
+    def count(self, name, n=1):
+        if self._enabled:
+            self._counts[name] += n
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        if not self._enabled:
+            yield
+            return
+        counts = dict(self._counts)
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            for key in self.counters:
+                args[key] = self._counts[key] - counts[key]
+            self._events.append({
+                'name': name,
+                'cat': 'biu',
+                'ph': 'X',
+                'pid': os.getpid(),
+                'tid': 0,
+                'ts': int(wall * 1e6),
+                'dur': int((time.time() - wall) * 1e6),
+                'tdur': int((time.clock() - cpu) * 1e6),
+                'args': args,
+            })
+
+    def take(self):
+        """
+        Return the recorded events and forget them, eg: to be sent from a
+        worker process to its parent.
+        """
+        events, self._events = self._events, []
+        return events
+
+    def merge(self, events):
+        self._events += events
+
+    def dump(self, fname):
+        """
+        Write the phases as a trace which is loaded by chrome://tracing.
+        """
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': self._events,
+                       'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """
+        Print the phases in order, a nested phase is indented under its
+        parent. The phases of this process precede those of workers, which
+        ran concurrently with them, so each worker is a labeled section.
+        """
+        say('%-36s %-16s %9s %9s %7s %7s %10s', 'phase', 'artifact',
+            'wall(ms)', 'cpu(ms)', 'reads', 'stats', 'bytes')
+        pid = os.getpid()
+        stack = []
+        depth = 0
+        for event in sorted(self._events,
+                            key=lambda event: (event['pid'] != pid,
+                                               event['pid'], event['ts'],
+                                               -event['dur'])):
+            if event['pid'] != pid:
+                pid, stack, depth = event['pid'], [], 1
+                say('worker %d', pid)
+            while stack and event['ts'] >= stack[-1]:
+                stack.pop()
+            args = event['args']
+            name = '  ' * (depth + len(stack)) + event['name']
+            if 'module' in args:
+                name += ' [%s]' % args['module']
+            say('%-36s %-16s %9.1f %9.1f %7d %7d %10d', name,
+                args.get('artifact', ''), event['dur'] / 1e3,
+                event['tdur'] / 1e3, args['reads'], args['stats'],
+                args['bytes'])
+            stack.append(event['ts'] + event['dur'])
+
+
+profiler = Profiler()
+
+
+def ninja_escape(path):
+    """
+    Escape the special characters of a path in a ninja file.
+    """
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
 class Options(dict):
     """
     A parsed options from command line.
@@ -91,7 +230,7 @@ class Options(dict):
 
     def __getattr__(self, name):
         try:
-            return self._args[name]
+            return self[name]
         except KeyError:
             return None
 
@@ -104,14 +243,24 @@ class OptionsParser:
     def __init__(self):
         self._args = {}
         self._actions = {}
+        self._aliases = {}
+        self._positional = None
         self.add_option('--help', help='Show this help',
                         typo='bool', default=False)
 
+    def add_positional(self, name, help):
+        """
+        Collect the arguments which are not options to a list of `name`.
+        """
+        self._positional = (name, help)
+
     def add_option(self, option, help, typo='str',
-                   required=False, default=None):
+                   required=False, default=None, alias=None):
         self._actions[option] = (typo, help, required, default)
+        if alias:
+            self._aliases[alias] = option
         if not required:
-            self._args[option] = default
+            self._args[option[2:]] = default
 
     def parse_args(self, argv):
         def convert(key, s):
@@ -129,10 +278,16 @@ class OptionsParser:
             raise ArgError()
 
         opts = Options(self._args)
+        if self._positional:
+            opts[self._positional[0]] = []
         size = len(argv)
         i = 0
         while i < size:
-            arg = argv[i]
+            arg = self._aliases.get(argv[i], argv[i])
+            if self._positional and not arg.startswith('-'):
+                opts[self._positional[0]].append(arg)
+                i += 1
+                continue
             if arg not in self._actions:
                 raise ArgError('option %s is unrecognized' % arg)
             typo, _, __, ___ = self._actions[arg]
@@ -156,10 +311,17 @@ class OptionsParser:
     def help(self, cmd='general'):
         s = cmd.title() + ' Options:\n'
         last = ''
+        if self._positional:
+            name, help = self._positional
+            s += '  %-20s %s\n' % ('<%s...>' % name, help)
+        aliases = {option: alias
+                   for alias, option in self._aliases.iteritems()}
         for key, (_, help, __, ___) in self._actions.iteritems():
             if '--help' == key:
                 last = '  %-20s %s\n' % (key, help)
             else:
+                if key in aliases:
+                    key = '%s, %s' % (aliases[key], key)
                 s += '  %-20s %s\n' % (key, help)
         return s + last
 
@@ -256,42 +418,927 @@ class Includes(list):
         return ' '.join(('-I %s' % arg for arg in iter(self)))
 
 
-class Storage:
+class FileSystem:
     """
-    Load and store a shelve db, also compare with current cache.
+    A view of the file system for a run of generation, in which every
+    directory is listed at most once, then the queries of existence and
+    globs are answered from memory. The view is reset before every run,
+    since files are changed among runs.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._listings = {}
+        self._mtimes = {}
+
+    def _listing(self, dirc):
+        # Returns the names in `dirc` both in order and as a set, or None
+        # if `dirc` is not a directory. Submodules are generated in their
+        # own workspaces, so the listings are keyed by absolute paths.
+        key = os.path.abspath(dirc or '.')
+        if key not in self._listings:
+            profiler.count('stats')
+            try:
+                names = os.listdir(key)
+                self._listings[key] = (names, set(names))
+            except OSError:
+                self._listings[key] = None
+        return self._listings[key]
+
+    def invalidate(self, dirc):
+        """
+        Forget the listing of `dirc`, eg: files were generated into it.
+        """
+        self._listings.pop(os.path.abspath(dirc or '.'), None)
+
+    def isdir(self, path):
+        return self._listing(path) is not None
+
+    def exists(self, path):
+        dirc, name = os.path.split(os.path.normpath(path))
+        if name in ('.', '..') or not name:
+            return self.isdir(path)
+        listing = self._listing(dirc)
+        return listing is not None and name in listing[1]
+
+    def getmtime(self, path):
+        key = os.path.abspath(path)
+        if key not in self._mtimes:
+            profiler.count('stats')
+            self._mtimes[key] = os.path.getmtime(key)
+        return self._mtimes[key]
+
+    def glob(self, pattern):
+        """
+        Return the paths matching `pattern` like `glob.glob`.
+        """
+        if not glob.has_magic(pattern):
+            if pattern.endswith(os.sep):
+                return [pattern] if self.isdir(pattern) else []
+            return [pattern] if self.exists(pattern) else []
+
+        dirc, base = os.path.split(pattern)
+        dircs = self.glob(dirc) if glob.has_magic(dirc) else [dirc]
+        if not base:
+            return [os.path.join(dirc, '') for dirc in dircs
+                    if self.isdir(dirc)]
+        paths = []
+        for dirc in dircs:
+            listing = self._listing(dirc)
+            if listing is None:
+                continue
+            names = listing[0]
+            if base[0] != '.':
+                names = [name for name in names if name[0] != '.']
+            paths += [os.path.join(dirc, name)
+                      for name in fnmatch.filter(names, base)]
+        return paths
+
+
+filesystem = FileSystem()
+
+
+def scan(path):
+    """
+    Return the names of the headers which are included by `path`, the digest
+    of its content and the size of it.
+    """
+    with open(path) as f:
+        content = f.read()
+    return (IncludeGraph.pattern.findall(content),
+            hashlib.md5(content).digest(), len(content))
+
+
+class ScanCache:
+    """
+    A persistent cache which maps a file to the headers it includes and the
+    digest of its content. An entry stays valid as long as the (mtime, size,
+    inode) of the file is unchanged.
     """
 
     def __init__(self, path='.biu'):
         if not os.path.exists(path):
             os.mkdir(path)
 
+        self._db = shelve.open(os.path.join(path, 'scans'), protocol=2)
+
+    def stamp(self, path):
+        profiler.count('stats')
+        st = os.stat(path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def get(self, path, stamp):
+        entry = self._db.get(path)
+        if entry is not None and len(entry) == 3 and entry[0] == stamp:
+            return entry[1:]
+        return None
+
+    def set(self, path, stamp, headers, digest):
+        """
+        Set the entry of `path`, return the mtime it was scanned at last time
+        if only its stat is changed since then, ie: it was touched.
+        """
+        entry = self._db.get(path)
+        self._db[path] = (stamp, headers, digest)
+        if entry is not None and len(entry) == 3 and entry[2] == digest:
+            return entry[0][0]
+        return None
+
+    def close(self):
+        self._db.close()
+
+
+class IncludeGraph:
+    """
+    A module-wide graph of `#include "..."` directives. Each file is parsed
+    at most once and the transitive closure of each file is memoized per set
+    of include paths, so it is shared by all sources and artifacts.
+    """
+
+    pattern = re.compile(r'^#include\s+"([^"]+)"', re.M)
+
+    def __init__(self, cache=None, pool=None, root=''):
+        self._cache = cache
+        self._pool = pool
+        self._root = root
+        self._headers = {}
+        self._digests = {}
+        self._resolved = {}
+        self._edges = {}
+        self._closures = {}
+        self._touched = {}
+
+    def _load(self, paths):
+        misses = collections.OrderedDict()
+        for path in paths:
+            if path in self._headers or path in misses:
+                continue
+            stamp = entry = None
+            if self._cache is not None:
+                stamp = self._cache.stamp(os.path.join(self._root, path))
+                entry = self._cache.get(path, stamp)
+            if entry is None:
+                misses[path] = stamp
+            else:
+                self._headers[path], self._digests[path] = entry
+
+        mapper = map
+        if self._pool is not None and len(misses) > 1:
+            mapper = self._pool.map
+        # Paths are relative to `root`, which is not the current directory of
+        # this process or of the pool.
+        for (path, stamp), (headers, digest, size) in zip(
+                misses.iteritems(),
+                mapper(scan, [os.path.join(self._root, path)
+                              for path in misses])):
+            profiler.count('reads')
+            profiler.count('bytes', size)
+            if stamp is not None:
+                mtime = self._cache.set(path, stamp, headers, digest)
+                if mtime is not None:
+                    self._touched[path] = mtime
+            self._headers[path] = headers
+            self._digests[path] = digest
+
+    def headers(self, path):
+        """
+        Return the names of the headers which are included by `path`.
+        """
+        if path not in self._headers:
+            self._load([path])
+        return self._headers[path]
+
+    def digest(self, path):
+        """
+        Return the digest of the content of `path`.
+        """
+        if path not in self._digests:
+            self._load([path])
+        return self._digests[path]
+
+    def touched(self):
+        """
+        Return the files which were touched but not changed since scanned
+        last time, mapped to their mtimes scanned last time, and forget them.
+        """
+        touched, self._touched = self._touched, {}
+        return touched
+
+    def prefetch(self, pairs):
+        """
+        Parse all of files reachable from `pairs` of (path, includes) level
+        by level, every level is scanned by the pool concurrently.
+        """
+        seen = set()
+        while pairs:
+            self._load([path for path, _ in pairs])
+            frontier = []
+            for pair in pairs:
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                path, includes = pair
+                frontier += [(dep, includes)
+                             for dep in self._expand(path, includes)]
+            pairs = frontier
+
+    def _resolve(self, header, includes):
+        key = (header, includes)
+        if key not in self._resolved:
+            self._resolved[key] = None
+            for include in includes:
+                path = os.path.join(include, header)
+                if filesystem.exists(os.path.join(self._root, path)):
+                    self._resolved[key] = path
+                    break
+        return self._resolved[key]
+
+    def includes(self, path, includes):
+        """
+        Return the files which are included by `path` directly.
+        """
+        return self._expand(path, includes)
+
+    def _expand(self, path, includes):
+        key = (path, includes)
+        paths = self._edges.get(key)
+        if paths is None:
+            paths = []
+            for header in self.headers(path):
+                resolved = self._resolve(header, includes)
+                if resolved is not None:
+                    paths.append(resolved)
+            self._edges[key] = paths
+        return paths
+
+    def closure(self, path, includes):
+        """
+        Return `path` followed by all of files it includes transitively.
+        """
+        key = (path, includes)
+        if key not in self._closures:
+            self._walk(path, includes)
+        return self._closures[key]
+
+    def _walk(self, path, includes):
+        """
+        Memoize the closures of `path` and of all of files reachable from it
+        by a depth-first walk, in which every file is expanded once. The
+        files of an include cycle, ie: a strongly connected component found
+        by Tarjan's algorithm, share the files of their closures.
+        """
+        edges = {path: self._expand(path, includes)}
+        index = {path: 0}
+        lowlink = {path: 0}
+        stack = [path]
+        walking = [(path, iter(edges[path]))]
+        while walking:
+            node, children = walking[-1]
+            for child in children:
+                if (child, includes) in self._closures:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    edges[child] = self._expand(child, includes)
+                    stack.append(child)
+                    walking.append((child, iter(edges[child])))
+                    break
+                if child in lowlink:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                walking.pop()
+                if walking:
+                    parent = walking[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    first = stack.index(node)
+                    members = stack[first:]
+                    del stack[first:]
+                    for member in members:
+                        del lowlink[member]
+                    self._memoize(members, edges, includes)
+
+    def _memoize(self, members, edges, includes):
+        # Every file which is included by the members but not one of them
+        # is memoized already.
+        cycle = set(members)
+        files = []
+        seen = set(cycle)
+        for member in members:
+            for child in edges[member]:
+                if child in cycle:
+                    continue
+                for prereq in self._closures[(child, includes)]:
+                    if prereq not in seen:
+                        seen.add(prereq)
+                        files.append(prereq)
+        for member in members:
+            self._closures[(member, includes)] = \
+                [member] + [other for other in members if other != member] + \
+                files
+
+    def invalidate(self, paths, structural=False):
+        """
+        Forget the files of `paths` (absolute) which were changed. All of
+        resolutions are forgot as well if some file was created or deleted.
+        """
+        changed = set(path for path in self._headers
+                      if os.path.normpath(os.path.join(self._root, path))
+                      in paths)
+        for path in changed:
+            del self._headers[path]
+            del self._digests[path]
+        if structural:
+            self._resolved.clear()
+            self._edges.clear()
+            self._closures.clear()
+            return
+        self._edges = {key: val for key, val in self._edges.iteritems()
+                       if key[0] not in changed}
+        self._closures = {key: val for key, val in self._closures.iteritems()
+                          if not changed.intersection(val)}
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+
+
+class Storage:
+    """
+    Load and store a sqlite db, also compare with current cache. Every target
+    has a signature which digests its command and the content of its prereqs,
+    a target is only out of date when the signature is changed. A target is
+    also stamped with the signature it is known to be built from, since make
+    may build it from other content before the next generation. The db is
+    loaded on demand, only the changed rows are written back and identical
+    lists of prereqs are stored once. A reverse index maps each prereq to
+    the targets depending on it directly, and each header to the files
+    including it, to query the artifacts affected by files. The rows of the
+    shelve db used by former versions are imported once.
+    """
+
+    version = 2
+
+    def __init__(self, path='.biu', root=''):
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        self._root = root
         self._cache = {}
-        self._db = shelve.open(os.path.join(path, 'targets'))
+        self._depends = {}
+        self._includes = None
+        self._complete = True
+        self._normpaths = {}
+        self._rows = None
+        self._db = sqlite3.connect(os.path.join(path, 'targets.db'))
+        self._db.text_factory = str
+        version, = self._db.execute('PRAGMA user_version').fetchone()
+        if version != self.version:
+            # The db of an old version is discarded, and all of rows are
+            # written again by the next save.
+            self._db.executescript("""
+                DROP TABLE IF EXISTS prereqs;
+                DROP TABLE IF EXISTS targets;
+                DROP TABLE IF EXISTS dependents;
+                DROP TABLE IF EXISTS stamps;
+                PRAGMA user_version = %d;
+            """ % self.version)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS prereqs (
+                id INTEGER PRIMARY KEY,
+                paths TEXT UNIQUE NOT NULL);
+            CREATE TABLE IF NOT EXISTS targets (
+                target TEXT PRIMARY KEY,
+                prereqs INTEGER NOT NULL,
+                command TEXT NOT NULL,
+                is_obj INTEGER NOT NULL,
+                signature TEXT,
+                name TEXT,
+                kind TEXT);
+            CREATE TABLE IF NOT EXISTS dependents (
+                prereq TEXT NOT NULL,
+                target TEXT NOT NULL,
+                included INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS dependents_prereq
+                ON dependents (prereq);
+            CREATE INDEX IF NOT EXISTS dependents_target
+                ON dependents (target);
+            CREATE TABLE IF NOT EXISTS stamps (
+                target TEXT PRIMARY KEY,
+                signature TEXT NOT NULL,
+                mtime REAL NOT NULL);
+        """)
+        if version != self.version:
+            self._migrate(os.path.join(path, 'targets'))
+
+    def _migrate(self, fname):
+        """
+        Import the rows of the shelve db at `fname`, then delete it. The rows
+        are not stamped, so their targets are verified by the mtimes of their
+        prereqs once they are changed, like `make` does.
+        """
+        # The files written by dbhash, gdbm or dumbdbm.
+        files = [name for name in (fname, fname + '.dat', fname + '.dir',
+                                   fname + '.bak') if os.path.exists(name)]
+        if not files:
+            return
+        try:
+            db = shelve.open(fname, 'r')
+            try:
+                rows = dict(db)
+            finally:
+                db.close()
+        except Exception:
+            # A db of an unavailable backend is dropped, so every target is
+            # compared as a new one.
+            rows = {}
+        with self._db:
+            keys = {}
+            self._db.executemany(
+                'INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(target, self._intern(tuple(entry[0]), keys), entry[1],
+                  bool(entry[2]), entry[3] if len(entry) > 3 else None, None,
+                  None) for target, entry in rows.iteritems()])
+            self._db.executemany(
+                'INSERT INTO dependents VALUES (?, ?, ?)',
+                [(self._normpath(prereq), self._normpath(target), False)
+                 for target, entry in rows.iteritems()
+                 for prereq in entry[0]])
+        for name in files:
+            os.remove(name)
+
+    def _load(self):
+        if self._rows is None:
+            lists = {}
+            for key, paths in self._db.execute(
+                    'SELECT id, paths FROM prereqs'):
+                lists[key] = tuple(paths.split('\n')) if paths else ()
+            self._rows = {}
+            for row in self._db.execute('SELECT * FROM targets'):
+                target, key, command, is_obj, signature, name, kind = row
+                self._rows[target] = (lists[key], command, bool(is_obj),
+                                      signature, name, kind)
+        return self._rows
+
+    def set(self, target, prereqs, command, is_obj, signature=None,
+            name=None, kind=None, depends=None):
+        """
+        Set a target, an artifact is also named by its `name` and `kind`.
+        Its prereqs are `depends` if given, eg: along with the headers
+        discovered by the compiler, otherwise `prereqs`.
+        """
+        self._cache[target] = (tuple(prereqs), command, bool(is_obj),
+                               signature, name, kind)
+        if depends is not None:
+            self._depends[target] = depends
+
+    def set_includes(self, includes, complete=True):
+        """
+        Set the files included by each file of `includes` directly, which
+        are indexed along with the targets. The files missing in `includes`
+        are forgot if it is `complete`.
+        """
+        self._includes = includes
+        self._complete = complete
+
+    def _normpath(self, path):
+        # Files are shared by lots of targets, so are normalized once.
+        normpath = self._normpaths.get(path)
+        if normpath is None:
+            normpath = self._normpaths[path] = os.path.normpath(path)
+        return normpath
+
+    def _changed_includes(self):
+        # Returns the files of which the includes are changed or forgot,
+        # along with the new edges of them.
+        if self._includes is None:
+            return [], []
+        old = collections.defaultdict(set)
+        for prereq, path in self._db.execute(
+                'SELECT prereq, target FROM dependents WHERE included'):
+            old[path].add(prereq)
+        changed = []
+        edges = []
+        for path, headers in self._includes.iteritems():
+            path = self._normpath(path)
+            headers = set(self._normpath(header) for header in headers)
+            if old.pop(path, set()) != headers:
+                changed.append((path,))
+                edges += [(header, path, True) for header in headers]
+        if self._complete:
+            changed += [(path,) for path in old]
+        return changed, edges
+
+    def _direct(self, prereqs):
+        # Drops the headers included by another prereq, which are reached by
+        # walking the includes instead.
+        includes = self._includes
+        if not includes:
+            return prereqs
+        covered = set()
+        covered.update(*[includes[prereq] for prereq in prereqs
+                         if prereq in includes])
+        return [prereq for prereq in prereqs if prereq not in covered]
+
+    def _intern(self, prereqs, keys):
+        paths = '\n'.join(prereqs)
+        if paths not in keys:
+            self._db.execute('INSERT OR IGNORE INTO prereqs (paths) '
+                             'VALUES (?)', (paths,))
+            row = self._db.execute('SELECT id FROM prereqs WHERE paths = ?',
+                                   (paths,)).fetchone()
+            keys[paths] = row[0]
+        return keys[paths]
+
+    def save(self, cache=None, touched=()):
+        rows = self._load()
+        # Without rows, eg: in a fresh checkout, the targets are still
+        # restored from `cache`.
+        if rows or cache is not None:
+            self.compare(cache, touched)
+
+        changed = [(target, entry) for target, entry in self._cache.iteritems()
+                   if rows.get(target) != entry]
+        expired = [(target,) for target in rows if target not in self._cache]
+        files, edges = self._changed_includes()
+        if changed or expired or files:
+            with self._db:
+                keys = {}
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO targets VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    [(target, self._intern(entry[0], keys)) + entry[1:]
+                     for target, entry in changed])
+                self._db.executemany('DELETE FROM targets WHERE target = ?',
+                                     expired)
+                self._db.executemany('DELETE FROM stamps WHERE target = ?',
+                                     expired)
+                self._db.executemany(
+                    'DELETE FROM dependents WHERE target = ?',
+                    [(self._normpath(target),) for target, _ in changed] +
+                    [(self._normpath(target),) for target, in expired] +
+                    files)
+                self._db.executemany(
+                    'INSERT INTO dependents VALUES (?, ?, ?)',
+                    [(self._normpath(prereq), self._normpath(target),
+                      False)
+                     for target, entry in changed
+                     for prereq in self._direct(
+                         self._depends.get(target, entry[0]))] +
+                    edges)
+                self._db.execute('DELETE FROM prereqs WHERE id NOT IN '
+                                 '(SELECT prereqs FROM targets)')
+        self._rows = None
+        self._db.close()
 
-    def set(self, target, prereqs, command, is_obj):
-        self._cache[target] = (prereqs, command, is_obj)
+    def items(self):
+        return self._load().items()
 
-    def save(self):
-        if self._db:
-            self.compare()
+    def rows(self):
+        """
+        Return the entries of all of targets stored last time.
+        """
+        return self._load()
+
+    def signature(self, target):
+        """
+        Return the signature of `target` stored last time.
+        """
+        row = self._db.execute('SELECT signature FROM targets '
+                               'WHERE target = ?', (target,)).fetchone()
+        return row[0] if row is not None else None
 
-        self._db.clear()
-        self._db.update(self._cache)
+    def artifacts(self):
+        """
+        Return the (target, name, kind) of all of artifacts.
+        """
+        return self._db.execute('SELECT target, name, kind FROM targets '
+                                'WHERE NOT is_obj ORDER BY target').fetchall()
+
+    def affected(self, paths):
+        """
+        Return the (target, name, kind) of the artifacts which depend on any
+        of `paths` directly or transitively.
+        """
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS changed '
+                         '(path TEXT)')
+        self._db.execute('DELETE FROM changed')
+        self._db.executemany('INSERT INTO changed VALUES (?)',
+                             [(os.path.normpath(path),) for path in paths])
+        reached = set(path for path, in self._db.execute("""
+            WITH RECURSIVE affected(path) AS (
+                SELECT path FROM changed
+                UNION
+                SELECT target FROM dependents JOIN affected ON prereq = path)
+            SELECT path FROM affected"""))
+        return [(target, name, kind)
+                for target, name, kind in self.artifacts()
+                if os.path.normpath(target) in reached]
+
+    def close(self):
         self._db.close()
 
-    def compare(self):
-        delete = lambda x: os.path.exists(x) and os.remove(x)
-        for target, (prereqs, command, _) in self._cache.iteritems():
-            old_prereqs, old_command, _ = self._db.get(target, [None] * 3)
-            if prereqs != old_prereqs or command != old_command:
+    def stamp(self, stamps):
+        """
+        Record the (target, signature, mtime) of `stamps`, every target of
+        which is known to be built from its signature.
+        """
+        if stamps:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO stamps VALUES '
+                                     '(?, ?, ?)', stamps)
+
+    def _stamped(self, target, signature, mtime):
+        row = self._db.execute('SELECT signature, mtime FROM stamps '
+                               'WHERE target = ?', (target,)).fetchone()
+        return row is not None and tuple(row) == (signature, mtime)
+
+    def _path(self, path):
+        # Targets are relative to the workspace, which is `root`.
+        return os.path.join(self._root, path)
+
+    def _mtime(self, target):
+        try:
+            return os.path.getmtime(self._path(target))
+        except OSError:
+            return None
+
+    def _built(self, target, verified):
+        # Whether `target` is known to be built from its signature.
+        if target not in verified:
+            signature = self._cache[target][3]
+            mtime = self._mtime(target)
+            if signature and mtime is not None and \
+                    self._stamped(target, signature, mtime):
+                verified.add(target)
+        return target in verified
+
+    def _fresh(self, target, verified, refreshed, stamps):
+        """
+        Whether `target` is known to be built from its signature, or is made
+        by the rules generated last time from the current content of its
+        prereqs, eg: by `make` after editing sources. It is stamped then, and
+        touched if some prereqs were touched but their content is unchanged,
+        so keeps `make` from rebuilding it.
+        """
+        prereqs, command, _, signature = self._cache[target][:4]
+        depends = self._depends.get(target, prereqs)
+        mtime = self._mtime(target)
+        if mtime is None or not signature:
+            return False
+        if not self._built(target, verified):
+            old = self._load().get(target)
+            if old is None or old[1] != command:
+                return False
+            # A target which is newer than all of its prereqs is built from
+            # their current content, as long as every prereq made by a rule
+            # is too. A prereq touched since is compared by its mtime before.
+            for prereq in depends:
+                if prereq in self._cache:
+                    if not self._fresh(prereq, verified, refreshed, stamps):
+                        return False
+                elif not os.path.isfile(self._path(prereq)):
+                    return False
+                if refreshed.get(prereq, self._mtime(prereq)) > mtime:
+                    return False
+            verified.add(target)
+            stamps.append((target, signature, mtime))
+        if self._outdated(mtime, depends):
+            os.utime(self._path(target), None)
+            stamps.append((target, signature, self._mtime(target)))
+            refreshed[target] = mtime
+        return True
+
+    def _outdated(self, mtime, prereqs):
+        mtimes = [self._mtime(prereq) for prereq in prereqs]
+        return any(prereq_mtime is not None and prereq_mtime > mtime
+                   for prereq_mtime in mtimes)
+
+    def compare(self, cache=None, touched=()):
+        """
+        Bring the targets in line with their signatures. Only the targets
+        whose rows are changed, or which depend on `touched` files (their
+        stat is changed but their content is not, mapped to their mtimes
+        before), are visited.
+        """
+        rows = self._load()
+        delete = lambda x: os.path.exists(self._path(x)) and \
+            os.remove(self._path(x))
+        # Objects are visited before the targets linking them, so a touched
+        # object is still older than a touched artifact. So are precompiled
+        # headers before the objects including them.
+        items = sorted(self._cache.iteritems(),
+                       key=lambda item: (not item[1][2],
+                                         not item[0].endswith('.gch')))
+        stamps = []
+        verified = set()
+        refreshed = dict(touched)
+        # The targets made by `make` since are visited as well, so they are
+        # stored to `cache` once they are known to be built from their
+        # signatures.
+        stamped = {}
+        if cache is not None:
+            stamped = dict(self._db.execute(
+                'SELECT target, signature FROM stamps'))
+        for target, entry in items:
+            prereqs, command, is_obj, signature = entry[:4]
+            depends = self._depends.get(target, prereqs)
+            old = rows.get(target)
+            if old == entry and \
+                    not any(prereq in refreshed for prereq in depends) and \
+                    (cache is None or stamped.get(target) == signature):
+                continue
+            old_prereqs, old_command, _, old_signature = (old or
+                                                          (None,) * 4)[:4]
+            fresh = self._fresh(target, verified, refreshed, stamps)
+            exists = self._mtime(target) is not None
+            # A target which has no row is left to `make`, since it is
+            # unknown what it was built from.
+            if not fresh and old is not None and (
+                    prereqs != old_prereqs or command != old_command or
+                    (is_obj and old_signature and signature != old_signature)):
                 delete(target)
-        expired_keys = set(self._db.keys()) - set(self._cache.keys())
+                exists = False
+            # An artifact is kept even if its signature is changed, since
+            # its objects are made again or restored before it anyway, and
+            # `biu make` doesn't link it again if they are byte-identical.
+            if cache is not None and signature:
+                if target in verified:
+                    cache.put(signature, self._path(target))
+                elif (not exists or not is_obj) and \
+                        cache.get(signature, self._path(target)):
+                    say('restore %s', target, color='green')
+                    verified.add(target)
+                    stamps.append((target, signature, self._mtime(target)))
+                    refreshed[target] = self._mtime(target)
+        self.stamp(stamps)
+        expired_keys = set(rows) - set(self._cache)
         for key in expired_keys:
             delete(key)
-        for target, (prereqs, _, is_obj) in self._db.iteritems():
-            if is_obj: continue
-            if set(prereqs) & expired_keys:
-                delete(target)
+        if expired_keys:
+            for target, (prereqs, _, is_obj, _, _, _) in rows.iteritems():
+                if is_obj: continue
+                if expired_keys.intersection(prereqs):
+                    delete(target)
+        if cache is not None and (stamps or expired_keys):
+            cache.evict()
+
+
+def clone(src, dst):
+    """
+    Copy `src` to `dst` by a reflink if the filesystem supports it, or by a
+    plain copy otherwise. `dst` is replaced atomically.
+    """
+    ficlone = 0x40049409
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(tmp, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), ficlone, fsrc.fileno())
+                except (IOError, OSError):
+                    shutil.copyfileobj(fsrc, fdst)
+        shutil.copymode(src, tmp)
+        os.rename(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ArtifactCache:
+    """
+    A local content-addressed cache of targets, ie: objects, archives, shared
+    objects and binaries, which can be shared by all of checkouts on a host.
+    An entry is keyed by the signature of a target, and entries are evicted
+    in least recently used order when the cache grows beyond `size`.
+
+    Entries are restored by reflinks or copies rather than hard links, since
+    compilers and `ar` may rewrite an existing output in place.
+    """
+
+    def __init__(self, path, size='10G'):
+        self._path = os.path.abspath(os.path.expanduser(path))
+        self._size = self._parse_size(size)
+
+    def _parse_size(self, size):
+        units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+        size = str(size).upper()
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+
+    def _entry(self, key):
+        return os.path.join(self._path, key[:2], key)
+
+    def get(self, key, target):
+        """
+        Restore `target` from the entry of `key`, return False if missed.
+        """
+        entry = self._entry(key)
+        if not os.path.exists(entry):
+            return False
+        try:
+            dirc = os.path.dirname(target)
+            if dirc and not os.path.exists(dirc):
+                os.makedirs(dirc)
+            clone(entry, target)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put(self, key, target):
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        try:
+            dirc = os.path.dirname(entry)
+            if not os.path.exists(dirc):
+                os.makedirs(dirc)
+            clone(target, entry)
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self._path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self._size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class Fingerprint:
+    """
+    Digest the inputs of a module, ie: the BUILD, the globbed sources and the
+    stat of every dependency, to tell whether a rebuild would be a no-op. The
+    signatures of SUBMODULE libraries are digested apart, since they are only
+    known once the submodules are generated.
+    """
+
+    def __init__(self, path='.biu', root=''):
+        self._path = os.path.join(path, 'fingerprint')
+        self._root = root
+        self._digest = None
+        self._subs = None
+        self._files = []
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                lines = f.read().splitlines()
+            if len(lines) > 1:
+                self._digest, self._subs = lines[:2]
+                self._files = lines[2:]
+
+    def digest(self, state, files):
+        md5 = hashlib.md5(state)
+        profiler.count('stats', len(files))
+        for path in files:
+            try:
+                st = os.stat(os.path.join(self._root, path))
+                md5.update('%s %r %d\n' % (path, st.st_mtime, st.st_size))
+            except OSError:
+                md5.update('%s\n' % path)
+        return md5.hexdigest()
+
+    def clear(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._digest = None
+
+    def _sign(self, subs):
+        return hashlib.md5(repr(sorted(subs.iteritems()))).hexdigest()
+
+    def match(self, state):
+        return self._digest == self.digest(state, self._files)
+
+    def match_subs(self, subs):
+        return self._subs == self._sign(subs)
+
+    def save(self, state, subs, files):
+        with open(self._path, 'w') as f:
+            f.write(self.digest(state, files))
+            f.write('\n')
+            f.write(self._sign(subs))
+            f.write('\n')
+            for path in files:
+                f.write(path)
+                f.write('\n')
 
 
 class MakeRule:
@@ -301,10 +1348,12 @@ class MakeRule:
         COMMAND
     """
 
-    def __init__(self, target, prereqs=(), command=''):
+    def __init__(self, target, prereqs=(), command='', fmt=None, args=None):
         self._target = target
         self._prereqs = prereqs
         self._command = command
+        self._fmt = fmt
+        self._args = dict(args or {})
 
     def target(self):
         return self._target
@@ -315,6 +1364,17 @@ class MakeRule:
     def command(self):
         return self._command
 
+    def template(self, **kwargs):
+        """
+        Format the command again in which some arguments are replaced by
+        `kwargs`, eg: target='$out'.
+        """
+        if self._fmt is None:
+            return self._command
+        args = dict(self._args)
+        args.update(kwargs)
+        return self._fmt % args
+
     def __str__(self):
         prereqs = break_str(self._prereqs) if hasattr(self, '_prereqs') else ''
         s = '%s : %s' % (self._target, prereqs)
@@ -330,17 +1390,74 @@ class CompileRule(MakeRule):
     Generate a rule which compiles source file to object file.
     """
 
-    def __init__(self, fname, prereqs, args, artifact):
-        target = os.path.join(args['output'], 'objs', artifact, fname + '.o')
+    def __init__(self, fname, prereqs, args, artifact, pch=None,
+                 members=None):
+        self._members = members or [fname]
+        name = fname
+        if fname.startswith(args['output']):
+            # A source generated to the output, eg: a unity source.
+            name = os.path.relpath(fname, args['output'])
+        target = os.path.join(args['output'], 'objs', artifact, name + '.o')
         args['target'] = target
         args['sources'] = fname
         cc_fmt = '%(ccache)s %(cc)s -o %(target)s -c %(cflags)s %(includes)s ' \
                  '%(sources)s'
         cxx_fmt = '%(ccache)s %(cxx)s -o %(target)s -c %(cxxflags)s %(includes)s ' \
                   '%(sources)s'
+        if pch and not fname.endswith('.c'):
+            args['pch'] = pch
+            prereqs = list(prereqs) + [pch + '.gch']
+            cxx_fmt = '%(ccache)s %(cxx)s -o %(target)s -c %(cxxflags)s ' \
+                      '%(includes)s -include %(pch)s -Winvalid-pch %(sources)s'
         fmt = cc_fmt if fname.endswith('.c') else cxx_fmt
+        self._depfile = None
+        if args.get('deps') == 'compiler':
+            self._depfile = target + '.d'
+            fmt += ' -MMD -MP -MF %(target)s.d'
         command = fmt % args
-        MakeRule.__init__(self, target, prereqs, command)
+        MakeRule.__init__(self, target, prereqs, command, fmt, args)
+
+    def source(self):
+        return self._args['sources']
+
+    def pch(self):
+        """
+        Return the precompiled header included by force, or None.
+        """
+        return self._args.get('pch')
+
+    def members(self):
+        """
+        Return the sources compiled by the rule, which are included by the
+        source if it is a unity source.
+        """
+        return self._members
+
+    def depfile(self):
+        """
+        Return the depfile written by the compiler, or None if the headers
+        are scanned by biu.
+        """
+        return self._depfile
+
+
+class PchRule(CompileRule):
+    """
+    Generate a rule which precompiles a header for C++ source files.
+    """
+
+    def __init__(self, fname, prereqs, args):
+        target = fname + '.gch'
+        args['target'] = target
+        args['sources'] = fname
+        fmt = '%(ccache)s %(cxx)s -o %(target)s -x c++-header -c ' \
+              '%(cxxflags)s %(includes)s %(sources)s'
+        self._depfile = None
+        if args.get('deps') == 'compiler':
+            self._depfile = target + '.d'
+            fmt += ' -MMD -MP -MF %(target)s.d'
+        command = fmt % args
+        MakeRule.__init__(self, target, prereqs, command, fmt, args)
 
 
 class LinkRule(MakeRule):
@@ -356,7 +1473,7 @@ class LinkRule(MakeRule):
         fmt = '%(ccache)s %(cxx)s -o %(target)s %(objs)s %(ldflags)s ' \
               '-Xlinker "-(" %(ldlibs)s -Xlinker "-)"'
         command = fmt % args
-        MakeRule.__init__(self, target, prereqs, command)
+        MakeRule.__init__(self, target, prereqs, command, fmt, args)
 
 
 class SharedRule(MakeRule):
@@ -366,12 +1483,12 @@ class SharedRule(MakeRule):
 
     def __init__(self, name, prereqs, objs, args):
         target = os.path.join(args['output'], 'lib', name)
-        args['target'] = self._target
+        args['target'] = target
         args['objs'] = break_str(objs)
-        fmt = '%(ccache)s %(cxx)s -o %(target)s shared -fPIC' \
+        fmt = '%(ccache)s %(cxx)s -o %(target)s -shared -fPIC ' \
               '%(objs)s %(ldflags)s -Xlinker "-(" %(ldlibs)s -Xlinker "-)"'
         command = fmt % args
-        MakeRule.__init__(self, target, prereqs, command)
+        MakeRule.__init__(self, target, prereqs, command, fmt, args)
 
 
 class StaticRule(MakeRule):
@@ -383,8 +1500,9 @@ class StaticRule(MakeRule):
         target = os.path.join(args['output'], 'lib', name)
         args['target'] = target
         args['objs'] = break_str(objs)
-        command = 'ar rcs %(target)s %(objs)s' % args
-        MakeRule.__init__(self, target, prereqs, command)
+        fmt = 'ar rcs %(target)s %(objs)s'
+        command = fmt % args
+        MakeRule.__init__(self, target, prereqs, command, fmt, args)
 
 
 class CleanRule(MakeRule):
@@ -402,14 +1520,19 @@ class Artifact:
     """
     An abstract class which produces a snippet of makefile. In which
     a snippet can makes a executable file(.out) or a shared object(.so)
-    or a archived file(.a).
+    or a archived file(.a). The `kind` of a subclass is shown by `biu
+    affected`, so it is short.
     """
 
-    def __init__(self, name, args, sources, sub_modules):
+    def __init__(self, name, args, sources, sub_modules, graph, objects,
+                 root=''):
         self._name = name
+        self._root = root
         self._args = args
         self._sources = sources
         self._sub_modules = sub_modules
+        self._graph = graph
+        self._objects = objects
         self._objs = []
         self._rule = None
         self._sub_rules = []
@@ -417,51 +1540,155 @@ class Artifact:
     def name(self):
         return self._name
 
+    def args(self):
+        return self._args
+
     def rule(self):
         return self._rule
 
     def obj_rules(self):
         return self._sub_rules
 
-    def build(self):
-        pattern = re.compile(r'^#include\s+"([^"]+)"', re.M)
-
-        def expand(headers, includes):
-            prereq_paths = []
-            for header in headers:
-                paths = [os.path.join(include, header) for include in includes]
-                for path in paths:
-                    if os.path.exists(path):
-                        prereq_paths.append(path)
-                        break
-            return prereq_paths
-
-        def search(source):
-            prereq_paths = []
-            # Create a dummy of original `includes` to append.
-            includes = list(self._args.get('includes', []))
-            seen = set()
-            queue = [source]
-            parent = os.path.dirname(source)
-            if parent:
-                includes.append(parent)
-            while queue:
-                first = queue.pop(0)
-                prereq_paths.append(first)
-                with open(first) as f:
-                    headers = pattern.findall(f.read())
-                    new_headers = filter(lambda x: x not in seen, headers)
-                    queue += expand(new_headers, includes)
-                    seen.update(new_headers)
-            return prereq_paths
+    def sources(self):
+        return self._sources
+
+    def include_paths(self, source):
+        """
+        Return the include paths used to resolve the headers of `source`.
+        """
+        includes = list(self._args.get('includes', []))
+        parent = os.path.dirname(source)
+        if parent:
+            includes.append(parent)
+        return tuple(includes)
+
+    def _scanned(self):
+        return self._args.get('deps') != 'compiler'
+
+    def _share(self, rule):
+        # Shares the rule with another artifact of the module which makes
+        # the same target from the same source by the same command.
+        shared = self._objects.setdefault(rule.template(target=''), rule)
+        if shared is rule:
+            self._sub_rules.append(rule)
+        return shared
+
+    def _hot_headers(self, sources, threshold):
+        counts = collections.defaultdict(int)
+        headers = []
+        for source in sources:
+            for header in self._graph.includes(source,
+                                               self.include_paths(source)):
+                if header not in counts:
+                    headers.append(header)
+                counts[header] += 1
+        least = max(2, threshold * len(sources))
+        return [header for header in headers if counts[header] >= least]
+
+    def _covers(self, closures, headers):
+        # Whether every source of `closures` includes all of `headers`, so
+        # including them by force doesn't change the meaning of any source.
+        # The headers of a source are unknown unless they are scanned.
+        if not self._scanned():
+            return True
+        return all(headers.issubset(os.path.normpath(path) for path in closure)
+                   for closure in closures)
+
+    def _precompile(self, closures):
+        """
+        Create a rule which precompiles the headers declared by `PCH`, or the
+        headers included by most of C++ sources if none is declared. Return
+        the path of the header to be included by sources, along with the
+        headers, or (None, None) if no source includes all of them.
+        """
+        if not self._args.get('precompile'):
+            return None, None
+        headers, threshold = self._args['precompile']
+        sources = [source for source in self._sources
+                   if not source.endswith('.c')]
+        if not headers and self._scanned():
+            headers = self._hot_headers(sources, threshold)
+        covered = set(os.path.normpath(header) for header in headers)
+        if not any(self._covers([closure], covered)
+                   for source, closure in zip(self._sources, closures)
+                   if not source.endswith('.c')):
+            return None, None
+
+        includes = tuple(self._args.get('includes', []))
+        md5 = hashlib.md5('%(ccache)s %(cxx)s %(cxxflags)s %(includes)s' %
+                          self._args)
+        md5.update('\n'.join(headers))
+        dirc = os.path.join(self._args['output'], 'pch', md5.hexdigest()[:12])
+        fname = os.path.join(dirc, 'pch.h')
+        update_file(os.path.join(self._root, fname),
+                    ''.join('#include "%s"\n' % os.path.relpath(header, dirc)
+                            for header in headers))
+        prereqs = [fname]
+        for header in headers:
+            if not self._scanned():
+                prereqs.append(header)
+                continue
+            parent = os.path.dirname(header)
+            paths = includes + (parent,) if parent else includes
+            prereqs += [prereq for prereq in self._graph.closure(header, paths)
+                        if prereq not in prereqs]
+        self._share(PchRule(fname, prereqs, self._args))
+        return fname, covered
+
+    def _unity(self, closures, size):
+        """
+        Concatenate every `size` sources of the same language into a unity
+        source, which depends on all of prereqs of its members. Return the
+        unity sources along with their prereqs and the closures of members.
+        """
+        groups = collections.OrderedDict()
+        for source, prereqs in zip(self._sources, closures):
+            ext = '.c' if source.endswith('.c') else '.cc'
+            groups.setdefault(ext, []).append((source, prereqs))
+
+        dirc = os.path.join(self._args['output'], 'unity', self._name)
+        units = []
+        for ext, members in groups.iteritems():
+            for i in range(0, len(members), size):
+                chunk = members[i:i + size]
+                fname = os.path.join(dirc, 'unity_%d%s' % (len(units), ext))
+                update_file(os.path.join(self._root, fname),
+                            ''.join('#include "%s"\n' %
+                                    os.path.relpath(source, dirc)
+                                    for source, _ in chunk))
+                prereqs = [fname]
+                for _, closure in chunk:
+                    prereqs += [prereq for prereq in closure
+                                if prereq not in prereqs]
+                units.append((fname, prereqs,
+                              [closure for _, closure in chunk]))
+        return units
 
+    def build(self):
         fmt = '[%%%dd/%%d] analyze %%s' % len(str(len(self._sources)))
+        closures = []
         for i, source in enumerate(self._sources):
+            if not self._scanned():
+                # Headers are discovered by the compiler while compiling.
+                closures.append([source])
+                continue
             say(fmt, i + 1, len(self._sources), source)
-            prereqs = search(source)
-            rule = CompileRule(source, prereqs, self._args, self._name)
-            self._objs.append(rule.target())
-            self._sub_rules.append(rule)
+            paths = self.include_paths(source)
+            closures.append(self._graph.closure(source, paths))
+
+        pch, headers = self._precompile(closures)
+        units = [(source, closure, [closure])
+                 for source, closure in zip(self._sources, closures)]
+        if self._args.get('unity'):
+            units = self._unity(closures, self._args['unity'])
+        for source, prereqs, members in units:
+            # A source which doesn't include all of precompiled headers is
+            # compiled without them.
+            rule = CompileRule(source, prereqs, self._args, self._name,
+                               pch if pch and self._covers(members, headers)
+                               else None,
+                               [closure[0] for closure in members])
+            self._objs.append(self._share(rule).target())
 
 
 class Binary(Artifact):
@@ -469,6 +1696,8 @@ class Binary(Artifact):
     Binary file.
     """
 
+    kind = 'binary'
+
     def build(self):
         Artifact.build(self)
         self._rule = LinkRule(self._name, self._objs + self._sub_modules,
@@ -480,6 +1709,8 @@ class Test(Artifact):
     Unit Test.
     """
 
+    kind = 'test'
+
     def build(self):
         Artifact.build(self)
         self._rule = LinkRule(self._name, self._objs + self._sub_modules,
@@ -491,6 +1722,8 @@ class SharedLibrary(Artifact):
     Shared Object.
     """
 
+    kind = 'shared'
+
     def build(self):
         Artifact.build(self)
         self._rule = SharedRule(self._name, self._objs + self._sub_modules,
@@ -502,12 +1735,219 @@ class StaticLibrary(Artifact):
     Static Libary
     """
 
+    kind = 'library'
+
     def build(self):
         Artifact.build(self)
         self._rule = StaticRule(self._name, self._objs + self._sub_modules,
                                 self._objs, self._args)
 
 
+class Protoc:
+    """
+    Compile `.proto` files to C++. A proto is stale when the digest of it
+    and the protos it imports transitively is changed. The stale protos of
+    a directory are compiled by a single invocation, the invocations run
+    concurrently, and an output is only rewritten when its content changes,
+    so a recompiled proto doesn't cascade into C++ rebuilds.
+    """
+
+    pattern = re.compile(
+        r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', re.M)
+
+    def __init__(self, protoc, protos, path='.biu', root=''):
+        self._protoc = protoc
+        self._root = root
+        self._protos = sorted(protos)
+        self._dirs = sorted(set(os.path.dirname(proto)
+                                for proto in self._protos))
+        self._path = os.path.join(path, 'protoc')
+        self._build_path = path
+        self._contents = {}
+        self._digests = {}
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                self._digests = json.load(f)
+
+    def _content(self, path):
+        if path not in self._contents:
+            with open(os.path.join(self._root, path)) as f:
+                self._contents[path] = f.read()
+        return self._contents[path]
+
+    def _imports(self, proto):
+        # An import which is not found in the proto paths, eg: one of
+        # `google/protobuf/`, is never changed by this module.
+        imports = []
+        for name in self.pattern.findall(self._content(proto)):
+            for dirc in self._dirs:
+                path = os.path.join(dirc, name)
+                if filesystem.exists(os.path.join(self._root, path)):
+                    imports.append(path)
+                    break
+        return imports
+
+    def _closure(self, proto):
+        closure = [proto]
+        for path in closure:
+            closure += [dep for dep in self._imports(path)
+                        if dep not in closure]
+        return closure
+
+    def _proto_paths(self):
+        return ' '.join('--proto_path ' + dirc for dirc in self._dirs)
+
+    def _digest(self, proto):
+        md5 = hashlib.md5('%s %s' % (self._protoc, self._proto_paths()))
+        for path in sorted(self._closure(proto)):
+            md5.update(path)
+            md5.update(hashlib.md5(self._content(path)).digest())
+        return md5.hexdigest()
+
+    def _outputs(self, proto):
+        pbname, _ = os.path.splitext(proto)
+        return pbname + '.pb.h', pbname + '.pb.cc'
+
+    def stale(self):
+        """
+        Return the protos which must be compiled.
+        """
+        path = lambda p: os.path.join(self._root, p)
+        stale = []
+        for proto in self._protos:
+            outputs = self._outputs(proto)
+            if not all(filesystem.exists(path(output)) for output in outputs):
+                stale.append(proto)
+            elif proto in self._digests:
+                if self._digests[proto] != self._digest(proto):
+                    stale.append(proto)
+            else:
+                # Compiled before the digests were recorded, so falls back
+                # to comparing the mtimes.
+                mtime = min(filesystem.getmtime(path(output))
+                            for output in outputs)
+                if any(filesystem.getmtime(path(dep)) >= mtime
+                       for dep in self._closure(proto)):
+                    stale.append(proto)
+                else:
+                    self._digests[proto] = self._digest(proto)
+        return stale
+
+    def _install(self, protos, tmp):
+        # protoc writes an output under the path relative to the proto path
+        # containing the proto, so finds the outputs by their names.
+        found = {}
+        for root, _, files in os.walk(tmp):
+            for name in files:
+                found[name] = os.path.join(root, name)
+        for proto in protos:
+            for output in self._outputs(proto):
+                with open(found[os.path.basename(output)]) as f:
+                    update_file(os.path.join(self._root, output), f.read())
+            self._digests[proto] = self._digest(proto)
+            filesystem.invalidate(
+                os.path.join(self._root, os.path.dirname(proto)))
+
+    def run(self, stale, module, jobs=None):
+        """
+        Compile the `stale` protos by batches, every directory is a batch,
+        and at most `jobs` batches run at the same time.
+        """
+        batches = collections.OrderedDict()
+        for proto in stale:
+            batches.setdefault(os.path.dirname(proto), []).append(proto)
+        batches = batches.values()
+        jobs = jobs or multiprocessing.cpu_count()
+        for i in range(0, len(batches), jobs):
+            running = []
+            for protos in batches[i:i + jobs]:
+                tmp = tempfile.mkdtemp(dir=self._build_path)
+                command = '%s %s --cpp_out=%s %s' % (
+                    self._protoc, self._proto_paths(), tmp, ' '.join(protos))
+                say(command, color='green')
+                proc = subprocess.Popen(command, shell=True,
+                                        cwd=self._root or None,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                running.append((protos, tmp, proc))
+            try:
+                for protos, tmp, proc in running:
+                    with profiler.phase('protoc', module=module,
+                                        protos=protos):
+                        text, _ = proc.communicate()
+                    assert proc.returncode == 0, text
+                    self._install(protos, tmp)
+            finally:
+                for _, tmp, proc in running:
+                    if proc.returncode is None:
+                        proc.wait()
+                    shutil.rmtree(tmp, True)
+        self.save()
+
+    def save(self):
+        update_file(self._path, json.dumps(self._digests, sort_keys=True))
+
+
+class StoredRule(MakeRule):
+    """
+    A rule loaded from `Storage` as it was generated last time.
+    """
+
+    def source(self):
+        return self._prereqs[0]
+
+    def members(self):
+        return [self.source()]
+
+    def depfile(self):
+        depfile = self._target + '.d'
+        return depfile if depfile in self._command else None
+
+
+class StoredArtifact:
+    """
+    An artifact which is not selected to be generated, so its rules are
+    loaded from `Storage` and emitted again as they were.
+    """
+
+    def __init__(self, name, target, rows, owned):
+        self._name = name
+        entry = rows[target]
+        self._rule = StoredRule(target, entry[0], entry[1])
+        self._sub_rules = []
+        self._rows = [(target, entry)]
+        # Collects the objects linked by the artifact, and the precompiled
+        # headers of them, unless they are shared by a selected artifact.
+        prereqs = list(self._rule.prereqs())
+        seen = set(owned)
+        for prereq in prereqs:
+            entry = rows.get(prereq)
+            if prereq in seen or entry is None or not entry[2]:
+                continue
+            seen.add(prereq)
+            self._sub_rules.append(StoredRule(prereq, entry[0], entry[1]))
+            self._rows.append((prereq, entry))
+            prereqs += entry[0]
+
+    def name(self):
+        return self._name
+
+    def args(self):
+        return {}
+
+    def rule(self):
+        return self._rule
+
+    def obj_rules(self):
+        return self._sub_rules
+
+    def sources(self):
+        return []
+
+    def rows(self):
+        return self._rows
+
+
 def to_list(args):
     """
     Convert the following types to list:
@@ -517,12 +1957,20 @@ def to_list(args):
     return args.split(' ') if isinstance(args, str) else list(args)
 
 
-def globs(args):
+def globs(args, root=''):
+    """
+    Expand the patterns of `args` which are relative to `root`, the paths are
+    relative to `root` as well.
+    """
+    prefix = os.path.join(root, '') if root else ''
     sources = []
     for path in args:
         if path.startswith('~/'):
             path = os.path.expanduser(path)
-        sources += glob.glob(path)
+        paths = filesystem.glob(os.path.join(root, path))
+        if prefix and not os.path.isabs(path):
+            paths = [found[len(prefix):] for found in paths]
+        sources += paths
     return sources
 
 
@@ -531,8 +1979,10 @@ class Module:
     Module represents a builder which builds a Makefile file.
     """
 
-    def __init__(self, workspace, build_path='.biu', output_path='output'):
+    def __init__(self, workspace, build_path='.biu', output_path='output',
+                 pool=None, graph=None, jobs=1):
         self._name = os.path.basename(workspace)
+        self._workspace = workspace
         self._vars = self._adjust({
             'cc': 'gcc',
             'cxx': 'g++',
@@ -542,17 +1992,38 @@ class Module:
             'ldflags': [],
             'ldlibs': [],
             'includes': [],
+            'precompile': None,
+            'deps': 'scan',
             'output': os.path.join(output_path, self._name, ''),
         })
         self._protoc = 'protoc'
-        self._storage = Storage(build_path)
+        self._jobs = jobs
+        self._cache = None
+        self._storage = Storage(self._path(build_path), workspace)
+        self._scans = None
+        if graph is None:
+            self._scans = ScanCache(self._path(build_path))
+            graph = IncludeGraph(self._scans, pool, workspace)
+        self._graph = graph
+        self._objects = {}
+        self._depfiles = {}
+        self._build_path = build_path
+        self._fragment = os.path.join(build_path, 'rules.mk')
+        self._fingerprint = Fingerprint(self._path(build_path), workspace)
         self._protos = set()
         self._proto_srcs = []
         self._artifacts = []
         self._sub_modules = []
+        self._sub_signatures = None
+        self._waited = False
         self._phonies = ['all', 'clean']
         self._output_path = output_path
 
+    def _path(self, path):
+        # Paths are relative to the workspace, which is not the current
+        # directory of this process.
+        return os.path.join(self._workspace, path)
+
     def set_cc(self, name_or_path):
         self._vars['cc'] = name_or_path
 
@@ -562,6 +2033,21 @@ class Module:
     def set_ccache(self, name_or_path):
         self._vars['ccache'] = name_or_path
 
+    def set_pch(self, headers, threshold):
+        self._vars['precompile'] = (globs(to_list(headers), self._workspace),
+                                    threshold)
+
+    def set_deps(self, mode):
+        if mode not in ('scan', 'compiler'):
+            raise ValueError('DEPS: %s is unsupported' % mode)
+        self._vars['deps'] = mode
+
+    def set_cache(self, path, size):
+        self._cache = ArtifactCache(path, size)
+
+    def cache(self):
+        return self._cache
+
     def add_cflags(self, flags):
         self._vars['cflags'].append(flags)
 
@@ -575,7 +2061,7 @@ class Module:
         self._vars['ldlibs'].append(libs)
 
     def add_sub_module(self, workspace, libs):
-        workspace = os.path.abspath(workspace)
+        workspace = os.path.abspath(os.path.join(self._workspace, workspace))
         name = os.path.basename(workspace.rstrip('/'))
         output = os.path.join(workspace, self._output_path, name, '')
         libs = [os.path.join(output, lib) for lib in to_list(libs)]
@@ -590,6 +2076,9 @@ class Module:
     def name(self):
         return self._name
 
+    def workspace(self):
+        return self._workspace
+
     def set_protoc(self, name_or_path):
         self._protoc = name_or_path
 
@@ -598,7 +2087,8 @@ class Module:
 
     def _adjust(self, kwargs):
         if 'includes' in kwargs:
-            kwargs['includes'] = Includes(globs(kwargs['includes']))
+            kwargs['includes'] = Includes(globs(kwargs['includes'],
+                                                self._workspace))
         if 'ldlibs' in kwargs:
             kwargs['ldlibs'] = LdLibs(kwargs['ldlibs'])
         for flags in ('cflags', 'cxxflags', 'ldflags'):
@@ -607,26 +2097,30 @@ class Module:
         return kwargs
 
     def _sanitize(self, sources, protos, kwargs):
-        sources = globs(to_list(sources))
-        protos = globs(to_list(protos))
+        with profiler.phase('globs', module=self._name):
+            sources = globs(to_list(sources), self._workspace)
+            protos = globs(to_list(protos), self._workspace)
+        unity = int(kwargs.pop('unity', 0))
         kwargs = {key: to_list(val) for key, val in kwargs.iteritems() if val}
         pbs = [proto.replace('.proto', '.pb.cc') for proto in protos]
         self._protos.update(protos)
         scope = Scope(self._vars)
         scope.extend(self._adjust(kwargs))
+        scope['unity'] = unity
         return scope, sources + pbs
 
     def _add_artifact(self, cls, name, sources, protos, kwargs):
         scope, srcs = self._sanitize(sources, protos, kwargs)
         sub_modules = [module for module, _, _ in self._sub_modules]
-        artifact = cls(name, scope, srcs, sub_modules)
+        artifact = cls(name, scope, srcs, sub_modules, self._graph,
+                       self._objects, self._workspace)
         self._artifacts.append(artifact)
 
     def add_binary(self, name, sources, protos, kwargs):
         self._add_artifact(Binary, name, sources, protos, kwargs)
 
     def add_test(self, name, sources, protos, kwargs):
-        self._add_artifact(Binary, name, sources, protos, kwargs)
+        self._add_artifact(Test, name, sources, protos, kwargs)
 
     def add_shared(self, name, sources, protos, kwargs):
         self._add_artifact(SharedLibrary, name, sources, protos, kwargs)
@@ -640,46 +2134,300 @@ class Module:
     def phonies(self):
         return self._phonies
 
+    def _sign_subs(self):
+        """
+        Return the digest of the signatures of the libraries of each
+        SUBMODULE, which is None if some of them is unknown. It is only called
+        once the SUBMODULEs are generated.
+        """
+        if self._sub_signatures is None:
+            self._sub_signatures = {}
+            for name, workspace, libs in self._sub_modules:
+                storage = Storage(os.path.join(workspace, self._build_path))
+                md5 = hashlib.md5()
+                for lib in libs:
+                    signature = storage.signature(
+                        os.path.relpath(lib, workspace))
+                    if signature is None:
+                        md5 = None
+                        break
+                    md5.update(signature)
+                storage.close()
+                self._sub_signatures[name] = md5 and md5.hexdigest()
+        return self._sub_signatures
+
     def _save(self):
+        def sign(command, prereqs, digest):
+            # A target has no signature if one of its prereqs is unknown.
+            md5 = hashlib.md5(command)
+            for prereq in prereqs:
+                if prereq in signatures and signatures[prereq] is None:
+                    return None
+                md5.update(prereq)
+                md5.update(signatures.get(prereq) or digest(prereq))
+            return md5.hexdigest()
+
         storage = self._storage
+        includes = {}
+        seen = set()
+        # A SUBMODULE prereq is signed by its libraries, so an artifact is
+        # linked again once they are changed.
+        signatures = dict(self._sign_subs())
         for artifact in self._artifacts:
+            if isinstance(artifact, StoredArtifact):
+                for target, entry in artifact.rows():
+                    storage.set(target, *entry)
+                continue
+            if artifact.args()['deps'] == 'scan':
+                for source in artifact.sources():
+                    paths = artifact.include_paths(source)
+                    for path in self._graph.closure(source, paths):
+                        if (path, paths) not in seen:
+                            seen.add((path, paths))
+                            includes.setdefault(path, set()).update(
+                                self._graph.includes(path, paths))
             for obj_rule in artifact.obj_rules():
+                prereqs = self._prereqs(obj_rule)
+                depfile = obj_rule.depfile()
+                signature = None
+                if not depfile or os.path.exists(self._path(depfile)):
+                    # The headers of an object which was never compiled in
+                    # compiler mode are unknown yet.
+                    signature = sign(obj_rule.command(), prereqs,
+                                     self._graph.digest)
+                signatures[obj_rule.target()] = signature
                 storage.set(obj_rule.target(), obj_rule.prereqs(),
-                            obj_rule.command(), True)
+                            obj_rule.command(), True, signature,
+                            depends=prereqs)
             rule = artifact.rule()
-            storage.set(rule.target(), rule.prereqs(), rule.command(), False)
-        storage.save()
-
-    def build(self, makefile):
-        for proto in self._protos:
-            pbname, _ = os.path.splitext(proto)
-            pbh, pbcc = pbname + '.pb.h', pbname + '.pb.cc'
-            self._proto_srcs += (pbh, pbcc)
-            if os.path.exists(pbh) and os.path.exists(pbcc):
-                pbh_mtime = os.path.getmtime(pbh)
-                pbcc_mtime = os.path.getmtime(pbcc)
-                proto_mtime = os.path.getmtime(proto)
-                if pbh_mtime > proto_mtime and pbcc_mtime > proto_mtime:
-                    continue
-
-            proto_dirs = set([os.path.dirname(path) for path in self._protos])
-            proto_paths = ' '.join(
-                ['--proto_path ' + proto_dir for proto_dir in proto_dirs])
-            command = '%s %s --cpp_out=%s %s' % (self._protoc, proto_paths,
-                                                 os.path.dirname(proto), proto)
-            say(command, color='green')
-            status, text = commands.getstatusoutput(command)
-            assert status == 0, text
-
+            signature = sign(rule.command(), rule.prereqs(), lambda _: '')
+            storage.set(rule.target(), rule.prereqs(), rule.command(), False,
+                        signature, artifact.name(), artifact.kind)
+        storage.set_includes(includes, not any(
+            isinstance(artifact, StoredArtifact)
+            for artifact in self._artifacts))
+        storage.save(self._cache, self._graph.touched())
+
+    def _discovered(self, depfile):
+        """
+        Return the headers written to `depfile` by the compiler last time,
+        which are empty if the object was never compiled.
+        """
+        if depfile not in self._depfiles:
+            try:
+                with open(self._path(depfile)) as f:
+                    content = f.read()
+            except IOError:
+                content = ''
+            # The first rule lists the prereqs of the target, the following
+            # ones are phony rules of headers.
+            rule = content.replace('\\\n', ' ').split('\n', 1)[0]
+            self._depfiles[depfile] = [
+                path for path in rule.partition(':')[2].split()
+                if os.path.exists(self._path(path))]
+        return self._depfiles[depfile]
+
+    def _prereqs(self, obj_rule):
+        prereqs = list(obj_rule.prereqs())
+        if obj_rule.depfile():
+            prereqs += [path for path in self._discovered(obj_rule.depfile())
+                        if path not in prereqs]
+        return prereqs
+
+    def _state(self, generator):
+        with open(os.path.join(self._workspace, 'BUILD')) as f:
+            content = f.read()
+        artifacts = [(artifact.__class__.__name__, artifact.name(),
+                      artifact.sources(), sorted(artifact.args().iteritems()))
+                     for artifact in self._artifacts]
+        return repr((__version__, generator, content,
+                     sorted(self._vars.iteritems()),
+                     self._protoc, sorted(self._protos), self._sub_modules,
+                     artifacts))
+
+    def _dependencies(self):
+        files = set(self._protos)
+        files.update(self._proto_srcs)
+        targets = set()
         for artifact in self._artifacts:
+            for source in artifact.sources():
+                files.update(artifact.include_paths(source))
+            for obj_rule in artifact.obj_rules():
+                files.update(self._prereqs(obj_rule))
+                if obj_rule.depfile():
+                    # Regenerates once the compiler rewrites the depfile.
+                    files.add(obj_rule.depfile())
+                targets.add(obj_rule.target())
+        return sorted(files - targets)
+
+    def _select(self, targets):
+        """
+        Keep the artifacts named by `targets` to be analyzed, and replace the
+        others by their rules generated last time.
+        """
+        selected = [artifact for artifact in self._artifacts
+                    if artifact.name() in targets]
+        for artifact in selected:
             say('[%s] artifact: %s', self._name, artifact.name())
-            artifact.build()
+            with profiler.phase('artifact', module=self._name,
+                                artifact=artifact.name()):
+                artifact.build()
             say('-' * 60)
 
-        self._make(makefile)
-        self._save()
-
-    def _make(self, makefile):
+        owned = set(obj_rule.target() for artifact in selected
+                    for obj_rule in artifact.obj_rules())
+        rows = self._storage.rows()
+        stored = {entry[4]: target for target, entry in rows.iteritems()
+                  if not entry[2]}
+        artifacts = []
+        for artifact in self._artifacts:
+            name = artifact.name()
+            if name not in targets:
+                if name not in stored:
+                    # Never generated, so there is nothing to keep.
+                    continue
+                artifact = StoredArtifact(name, stored[name], rows, owned)
+            artifacts.append(artifact)
+        self._artifacts = artifacts
+        # The module is partially generated, so must be generated again
+        # by the next full build.
+        self._fingerprint.clear()
+
+    def _wait(self, wait):
+        """
+        Wait for the SUBMODULEs by `wait`, which returns their summaries. The
+        protos compiled by them meanwhile may be included by this module, so
+        they are forgot by the include graph.
+        """
+        if wait is None or self._waited:
+            return
+        self._waited = True
+        paths = set(os.path.normpath(os.path.join(sub.workspace(), path))
+                    for sub in wait() for path in sub.proto_srcs())
+        for path in paths:
+            filesystem.invalidate(os.path.dirname(path))
+        if paths:
+            self._graph.invalidate(paths, True)
+
+    def build(self, fname, generator='make', root='', subs=(), targets=None,
+              wait=None):
+        """
+        Generate a `Makefile` or a `build.ninja` which is decided by the
+        `generator`. All of paths are prefixed by `root` in a ninja file or
+        a flat fragment, and the top file includes the files of all of
+        `subs` in ninja and flat modes. Only the artifacts named by
+        `targets` are analyzed if given, the others are kept as they were.
+        The SUBMODULEs may be generated meanwhile, in which case `wait` is
+        called before anything depending on them.
+        """
+        for proto in sorted(self._protos):
+            pbname, _ = os.path.splitext(proto)
+            self._proto_srcs += (pbname + '.pb.h', pbname + '.pb.cc')
+
+        names = [artifact.name() for artifact in self._artifacts]
+        unknown = [target for target in targets or () if target not in names]
+        if unknown:
+            say('[%s] unknown targets: %s', self._name, ' '.join(unknown),
+                color='red')
+            sys.exit(-1)
+
+        state = self._state(generator)
+        with profiler.phase('fingerprint', module=self._name):
+            fresh = (os.path.exists(self._path(fname)) and
+                     self._fingerprint.match(state))
+        if fresh:
+            self._wait(wait)
+            fresh = self._fingerprint.match_subs(self._sign_subs())
+        if fresh:
+            say('[%s] up to date', self._name)
+            self._storage.close()
+            if self._scans is not None:
+                self._scans.close()
+            return
+
+        if self._protos:
+            protoc = Protoc(self._protoc, self._protos,
+                            self._path(self._build_path), self._workspace)
+            stale = protoc.stale()
+            if stale:
+                protoc.run(stale, self._name, self._jobs)
+            else:
+                protoc.save()
+
+        with profiler.phase('prefetch', module=self._name):
+            self._graph.prefetch([(source, artifact.include_paths(source))
+                                  for artifact in self._artifacts
+                                  if artifact.args()['deps'] == 'scan'
+                                  if not targets or artifact.name() in targets
+                                  for source in artifact.sources()])
+        self._wait(wait)
+        if targets:
+            self._select(targets)
+        else:
+            for artifact in self._artifacts:
+                say('[%s] artifact: %s', self._name, artifact.name())
+                with profiler.phase('artifact', module=self._name,
+                                    artifact=artifact.name()):
+                    artifact.build()
+                say('-' * 60)
+
+        with profiler.phase(generator, module=self._name):
+            if generator == 'ninja':
+                self._ninja(fname, root, subs)
+            elif generator == 'flat' and not root:
+                self._make(fname, [os.path.join(workspace, self._fragment)
+                                   for workspace in subs])
+            else:
+                self._make(fname)
+                if generator == 'flat':
+                    self._flat(self._fragment, root)
+        with profiler.phase('compdb', module=self._name):
+            self._compdb('compile_commands.json')
+        with profiler.phase('save', module=self._name):
+            self._save()
+        if self._scans is not None:
+            self._scans.close()
+        if not targets:
+            with profiler.phase('fingerprint', module=self._name):
+                self._fingerprint.save(state, self._sign_subs(),
+                                       self._dependencies())
+
+    def _rebase(self, rule, root=''):
+        """
+        Return a copy of `rule` in which a SUBMODULE prereq is replaced by its
+        libraries, and all of paths are prefixed by `root` where the command
+        runs, so the rule can be made from another workspace.
+        """
+        def rebase(path):
+            if not root or os.path.isabs(path):
+                return path
+            return os.path.normpath(os.path.join(root, path))
+
+        sub_libs = {name: libs for name, _, libs in self._sub_modules}
+        prereqs = [rebase(lib) for prereq in rule.prereqs()
+                   for lib in sub_libs.get(prereq, [prereq])]
+        command = rule.command()
+        if root:
+            command = 'cd %s && %s' % (root, command)
+        return MakeRule(rebase(rule.target()), prereqs, command)
+
+    def _flat(self, fname, root):
+        """
+        Write the rules of a submodule as a fragment of the top Makefile.
+        """
+        rules = []
+        for artifact in self._artifacts:
+            rules.extend(self._rebase(obj_rule, root)
+                         for obj_rule in artifact.obj_rules())
+            rules.append(self._rebase(artifact.rule(), root))
+        update_file(self._path(fname),
+                    '\n'.join(str(rule) for rule in rules) + '\n')
+
+    def _make(self, makefile, fragments=None):
+        """
+        Write a Makefile which makes SUBMODULEs by `make -C`, or includes
+        the `fragments` of them to make a single graph of all of modules.
+        """
         targets = set()
         art_rules = []
         obj_rules = []
@@ -688,6 +2436,8 @@ class Module:
                 obj_rules.append(obj_rule)
                 targets.add(obj_rule.target())
             rule = artifact.rule()
+            if fragments is not None:
+                rule = self._rebase(rule)
             art_rules.append(rule)
             targets.add(rule.target())
 
@@ -702,41 +2452,179 @@ class Module:
         rules.append('')
         rules.extend(obj_rules)
         rules.append('')
-        for name, workspace, _ in self._sub_modules:
-            rules.append(MakeRule(name, (), 'make -C ' + workspace))
+        depfiles = [obj_rule.depfile() for obj_rule in obj_rules
+                    if obj_rule.depfile()]
+        if depfiles:
+            rules.append('-include ' + break_str(depfiles))
+            rules.append('')
+        if fragments is not None:
+            rules.extend('include ' + fragment for fragment in fragments)
             rules.append('')
+        else:
+            for name, workspace, _ in self._sub_modules:
+                rules.append(MakeRule(name, (), 'make -C ' + workspace))
+                rules.append('')
         rules.append('')
-        rules.append(CleanRule(sorted(targets)))
+        rules.append(CleanRule(sorted(targets) + depfiles))
+
+        self._make_env(targets)
+        with profiler.phase('write', module=self._name):
+            self._write_to(rules, makefile)
+
+    def _ninja(self, fname, root='', subninjas=()):
+        def rebase(path):
+            if not root or os.path.isabs(path):
+                return path
+            return os.path.normpath(os.path.join(root, path))
+
+        def paths(args):
+            return ' '.join(ninja_escape(rebase(arg)) for arg in args)
+
+        def flags(args):
+            # Rebases the paths in flags too, eg: -L. or -I src/, or a
+            # library in the workspace.
+            tokens = ' '.join(args).split()
+            for i, token in enumerate(tokens):
+                if i and tokens[i - 1] in ('-I', '-L', '-include',
+                                           '-isystem', '-iquote'):
+                    tokens[i] = rebase(token)
+                elif token[:2] in ('-I', '-L') and len(token) > 2:
+                    tokens[i] = token[:2] + rebase(token[2:])
+                elif root and not token.startswith('-') and \
+                        os.path.exists(os.path.join(root, token)):
+                    tokens[i] = rebase(token)
+            return ' '.join(tokens)
+
+        def escape(command):
+            # Protects `$` of the command, but not $in/$out of ninja.
+            command = command.replace('$', '$$')
+            command = command.replace('@in@', '$in').replace('@out@', '$out')
+            return ' '.join(filter(None, command.split(' ')))
+
+        templates = collections.OrderedDict()
+        edges = []
+        defaults = []
+        targets = set()
+        sub_libs = {name: libs for name, _, libs in self._sub_modules}
+        for artifact in self._artifacts:
+            for obj_rule in artifact.obj_rules():
+                includes = Includes(rebase(include) for include in
+                                    artifact.args().get('includes', []))
+                kwargs = {key: flags(artifact.args().get(key, []))
+                          for key in ('cflags', 'cxxflags')}
+                if obj_rule.pch():
+                    kwargs['pch'] = rebase(obj_rule.pch())
+                command = obj_rule.template(target='@out@', sources='@in@',
+                                            includes=includes, **kwargs)
+                command = escape(command)
+                if not command.endswith('$out.d'):
+                    command += ' -MMD -MF $out.d'
+                name = templates.setdefault(
+                    (command, True), '%s_rule%d' % (self._name, len(templates)))
+                edge = 'build %s: %s %s' % (paths([obj_rule.target()]), name,
+                                            paths(obj_rule.prereqs()[:1]))
+                # Depends on a precompiled header explicitly, other headers
+                # are discovered by depfiles.
+                pchs = [prereq for prereq in obj_rule.prereqs()
+                        if prereq.endswith('.gch')]
+                if pchs:
+                    edge += ' | ' + paths(pchs)
+                edges.append(edge)
+                targets.add(obj_rule.target())
+
+            rule = artifact.rule()
+            command = escape(rule.template(
+                target='@out@', objs='@in@',
+                ldflags=flags(artifact.args().get('ldflags', [])),
+                ldlibs=flags(artifact.args().get('ldlibs', []))))
+            name = templates.setdefault(
+                (command, False), '%s_rule%d' % (self._name, len(templates)))
+            objs = [prereq for prereq in rule.prereqs()
+                    if prereq not in sub_libs]
+            libs = [lib for prereq in rule.prereqs()
+                    for lib in sub_libs.get(prereq, [])]
+            edge = 'build %s: %s %s' % (paths([rule.target()]), name,
+                                        paths(objs))
+            if libs:
+                edge += ' | ' + paths(libs)
+            edges.append(edge)
+            defaults.append(rule.target())
+            targets.add(rule.target())
+
+        lines = [
+            '# file : build.ninja',
+            '# brief: this file was generated by `biu`',
+            '',
+            'ninja_required_version = 1.3',
+            '',
+        ]
+        for (command, depfile), name in templates.iteritems():
+            lines.append('rule %s' % name)
+            lines.append('  command = %s' % command)
+            if depfile:
+                lines.append('  depfile = $out.d')
+                lines.append('  deps = gcc')
+            lines.append('')
+        lines.extend(edges)
+        lines.append('')
+        for workspace in subninjas:
+            lines.append('subninja %s' % ninja_escape(
+                os.path.join(workspace, 'build.ninja')))
+        if root:
+            # Names the module itself instead of `all`, which is reserved
+            # for the top workspace.
+            lines.append('build %s: phony %s' % (self._name, paths(defaults)))
+        else:
+            lines.append('build all: phony %s' % paths(defaults))
+            lines.append('default all')
 
         self._make_env(targets)
-        self._write_to(rules, makefile)
+        with profiler.phase('write', module=self._name):
+            update_file(self._path(fname), '\n'.join(lines) + '\n')
 
     def _make_env(self, targets):
         for dirc in sorted((os.path.dirname(target) for target in targets)):
-            if not os.path.exists(dirc):
-                os.makedirs(dirc)
+            if not os.path.exists(self._path(dirc)):
+                os.makedirs(self._path(dirc))
         for name, workspace, _ in self._sub_modules:
             output = os.path.join(self._output_path, name)
             output = os.path.join(workspace, output)
-            linked_output = os.path.join(self._output_path, name)
+            linked_output = self._path(os.path.join(self._output_path, name))
             if os.path.islink(linked_output):
                 os.unlink(linked_output)
-            os.symlink(output, os.path.join(self._output_path, name))
+            os.symlink(output, linked_output)
+
+    def _compdb(self, fname):
+        """
+        Write a compilation database which is used by clangd, clang-tidy, etc.
+        The members of a unity source are written with its flags, since they
+        are the files edited.
+        """
+        entries = []
+        for artifact in self._artifacts:
+            for obj_rule in artifact.obj_rules():
+                if obj_rule.target().endswith('.gch'):
+                    continue
+                for source in obj_rule.members():
+                    command = obj_rule.command()
+                    if source != obj_rule.source():
+                        command = obj_rule.template(sources=source)
+                    entries.append(collections.OrderedDict((
+                        ('directory', self._workspace),
+                        ('command', ' '.join(command.split())),
+                        ('file', source),
+                        ('output', obj_rule.target()),
+                    )))
+        content = json.dumps(entries, indent=2, separators=(',', ': '))
+        update_file(self._path(fname), content + '\n')
 
     def _write_to(self, rules, makefile):
         notice = '\n'.join((
             '# file : Makefile',
             '# brief: this file was generated by `biu`',
-            '# date : %s' % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
         ))
-
-        with open(makefile, 'w') as out:
-            out.write(notice)
-            out.write('\n')
-            out.write('\n')
-            for rule in rules:
-                out.write(str(rule))
-                out.write('\n')
+        content = '\n'.join([notice, ''] + [str(rule) for rule in rules] + [''])
+        update_file(self._path(makefile), content)
 
 
 def api(module):
@@ -753,6 +2641,15 @@ def api(module):
     def CCACHE(arg):
         module.set_ccache(arg)
 
+    def PCH(headers=(), threshold=0.8):
+        module.set_pch(headers, threshold)
+
+    def DEPS(mode):
+        module.set_deps(mode)
+
+    def CACHE(path, size='10G'):
+        module.set_cache(path, size)
+
     def CFLAGS(arg):
         module.add_cflags(arg)
 
@@ -807,6 +2704,651 @@ class Template:
         return '\n\n'.join(lines) % kwargs
 
 
+class Executor:
+    """
+    Execute a graph of rules by a pool of subprocesses directly, instead of
+    writing it down to be parsed by `make` again. The ready rule with the
+    longest chain of work behind it is always started first. The digests of
+    the prereqs made by rules are kept in `path` for every target, so a
+    prereq which is made again with the same content doesn't make its
+    dependents stale.
+    """
+
+    def __init__(self, jobs=1, keep_going=False, path=None):
+        self._jobs = max(1, jobs)
+        self._keep_going = keep_going
+        self._nodes = collections.OrderedDict()
+        self._caches = {}
+        self._signatures = {}
+        self._made = {}
+        self._timings = {}
+        self._stats = {}
+        self._digests = {}
+        self._inputs = {}
+        self._path = path and os.path.join(path, 'inputs')
+        if self._path and os.path.exists(self._path):
+            with open(self._path) as f:
+                self._inputs = json.load(f)
+
+    def add(self, target, prereqs, command=None, cwd=None, signature=None,
+            cache=None):
+        """
+        Add a rule, a rule without a command is a phony target. The target is
+        restored from and stored to `cache` by its `signature` if given.
+        """
+        self._nodes[target] = (list(prereqs), command, cwd)
+        if signature:
+            self._signatures[target] = signature
+            if cache is not None:
+                self._caches[target] = (cache, signature)
+
+    def graph(self):
+        """
+        Return the prereqs of each target which are targets too.
+        """
+        return {target: [prereq for prereq in prereqs
+                         if prereq in self._nodes]
+                for target, (prereqs, _, _) in self._nodes.iteritems()}
+
+    def timings(self):
+        """
+        Return the (duration, peak RSS in KB) of each target made by `run`.
+        """
+        return self._timings
+
+    def stats(self):
+        return self._stats
+
+    def made(self):
+        """
+        Return the signature of each target made or restored by `run`.
+        """
+        return self._made
+
+    def _dependents(self):
+        dependents = collections.defaultdict(list)
+        for target, (prereqs, _, _) in self._nodes.iteritems():
+            for prereq in prereqs:
+                if prereq in self._nodes:
+                    dependents[prereq].append(target)
+        return dependents
+
+    def _priorities(self, dependents):
+        # The number of prereqs is a cheap estimate of the cost of a rule,
+        # eg: a source including many headers compiles slowly.
+        order = []
+        pending = {target: len(dependents[target]) for target in self._nodes}
+        queue = [target for target, count in pending.iteritems() if not count]
+        while queue:
+            target = queue.pop()
+            order.append(target)
+            for prereq in self._nodes[target][0]:
+                if prereq in pending:
+                    pending[prereq] -= 1
+                    if not pending[prereq]:
+                        queue.append(prereq)
+        priorities = {}
+        for target in order:
+            prereqs, command, _ = self._nodes[target]
+            cost = 1 + len(prereqs) if command else 0
+            priorities[target] = cost + max(
+                [priorities[dependent] for dependent in dependents[target]] or
+                [0])
+        return priorities
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _digest(self, path):
+        if path not in self._digests:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), ''):
+                    md5.update(chunk)
+            self._digests[path] = md5.hexdigest()
+        return self._digests[path]
+
+    def _record(self, target, prereqs):
+        # Keeps the digests of the prereqs which `target` is made from.
+        self._digests.pop(target, None)
+        inputs = {prereq: self._digest(prereq) for prereq in prereqs
+                  if prereq in self._nodes and self._nodes[prereq][1]}
+        if inputs:
+            self._inputs[target] = inputs
+        else:
+            self._inputs.pop(target, None)
+
+    def _stale(self, target, prereqs, rebuilt):
+        """
+        Whether `target` is missing, or some of its prereqs is newer than it.
+        A prereq made by a rule is compared by its content instead, and the
+        target is touched if it is made from the same content still.
+        """
+        mtime = self._mtime(target)
+        if mtime is None:
+            return True
+        changed = []
+        for prereq in prereqs:
+            node = self._nodes.get(prereq)
+            if node is not None and node[1] is None:
+                if prereq in rebuilt:
+                    return True
+                continue
+            prereq_mtime = self._mtime(prereq)
+            if prereq_mtime is None:
+                return True
+            if prereq in rebuilt or prereq_mtime > mtime:
+                if node is None:
+                    return True
+                changed.append(prereq)
+        if not changed:
+            return False
+        inputs = self._inputs.get(target, {})
+        if any(inputs.get(prereq) != self._digest(prereq)
+               for prereq in changed):
+            return True
+        os.utime(target, None)
+        if target in self._signatures:
+            self._made[target] = self._signatures[target]
+        return False
+
+    def run(self):
+        """
+        Execute all of stale rules, return True if none of them failed.
+        """
+        dependents = self._dependents()
+        priorities = self._priorities(dependents)
+        pending = {target: set(prereq for prereq in prereqs
+                               if prereq in self._nodes)
+                   for target, (prereqs, _, _) in self._nodes.iteritems()}
+        ready = [(-priorities[target], target)
+                 for target, prereqs in pending.iteritems() if not prereqs]
+        heapq.heapify(ready)
+        running = {}
+        rebuilt = set()
+        failed = set()
+        start = time.time()
+        busy = 0.0
+
+        def release(target):
+            for dependent in dependents[target]:
+                pending[dependent].discard(target)
+                if not pending[dependent]:
+                    heapq.heappush(ready, (-priorities[dependent], dependent))
+
+        while running or (ready and (self._keep_going or not failed)):
+            while ready and len(running) < self._jobs and \
+                    (self._keep_going or not failed):
+                _, target = heapq.heappop(ready)
+                prereqs, command, cwd = self._nodes[target]
+                if any(prereq in failed for prereq in prereqs):
+                    failed.add(target)
+                elif command is None:
+                    if any(prereq in rebuilt for prereq in prereqs):
+                        rebuilt.add(target)
+                elif self._stale(target, prereqs, rebuilt):
+                    missing = [prereq for prereq in prereqs
+                               if prereq not in self._nodes and
+                               not os.path.exists(prereq)]
+                    cache, signature = self._caches.get(target, (None, None))
+                    if missing:
+                        say('no rule to make target %s, needed by %s',
+                            missing[0], target, color='red')
+                        failed.add(target)
+                    elif cache is not None and cache.get(signature, target):
+                        say('restore %s', target, color='green')
+                        rebuilt.add(target)
+                        self._made[target] = signature
+                        self._record(target, prereqs)
+                    else:
+                        say(' '.join(filter(None, command.split(' '))))
+                        proc = subprocess.Popen(command, shell=True, cwd=cwd)
+                        # Keeps the Popen, otherwise it may reap the child by
+                        # its `__del__` before `wait4` does.
+                        running[proc.pid] = (target, time.time(), proc)
+                        continue
+                release(target)
+            if not running:
+                continue
+
+            pid, status, usage = os.wait4(-1, 0)
+            if pid not in running:
+                continue
+            target, began, proc = running.pop(pid)
+            proc.returncode = status
+            duration = time.time() - began
+            busy += duration
+            if status == 0:
+                self._timings[target] = (duration, usage.ru_maxrss)
+                rebuilt.add(target)
+                self._record(target, self._nodes[target][0])
+                if target in self._signatures:
+                    self._made[target] = self._signatures[target]
+                if target in self._caches:
+                    cache, signature = self._caches[target]
+                    cache.put(signature, target)
+            else:
+                say('failed to make target %s', target, color='red')
+                failed.add(target)
+            release(target)
+        for cache in set(cache for cache, _ in self._caches.itervalues()):
+            cache.evict()
+        if self._path:
+            with open(self._path, 'w') as f:
+                json.dump(self._inputs, f)
+        self._stats = {'jobs': self._jobs, 'wall': time.time() - start,
+                       'busy': busy, 'made': len(self._timings)}
+        return not failed
+
+
+class Telemetry:
+    """
+    The durations and peak RSS of the targets made by `Executor`, which are
+    kept among runs, so a target which is up to date keeps its last timing.
+    """
+
+    def __init__(self, path='.biu'):
+        self._path = os.path.join(path, 'telemetry')
+        self._targets = {}
+        self._stats = {}
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                data = json.load(f)
+            self._targets = data['targets']
+            self._stats = data['stats']
+
+    def record(self, graph, timings, stats):
+        targets = {}
+        for target, prereqs in graph.iteritems():
+            old = self._targets.get(target, (None, 0.0, 0))
+            duration, rss = timings.get(target, old[1:])
+            targets[target] = (prereqs, duration, rss)
+        self._targets = targets
+        if stats['made']:
+            # A no-op run keeps the stats of the last effective one.
+            self._stats = stats
+        with open(self._path, 'w') as f:
+            json.dump({'targets': targets, 'stats': self._stats}, f)
+
+    def stats(self):
+        return self._stats
+
+    def slowest(self, count, suffixes=('.o', '.gch')):
+        """
+        Return the (target, duration, rss) of the slowest translation units.
+        """
+        units = [(target, duration, rss)
+                 for target, (_, duration, rss) in self._targets.iteritems()
+                 if target.endswith(suffixes)]
+        return sorted(units, key=lambda unit: -unit[1])[:count]
+
+    def critical_path(self):
+        """
+        Return the chain of targets which takes the longest time to make even
+        with unlimited jobs.
+        """
+        costs = {}
+        nexts = {}
+        for target in self._targets:
+            stack = [target]
+            while stack:
+                top = stack[-1]
+                if top in costs:
+                    stack.pop()
+                    continue
+                prereqs = [prereq for prereq in self._targets[top][0]
+                           if prereq in self._targets]
+                todo = [prereq for prereq in prereqs if prereq not in costs]
+                if todo:
+                    stack += todo
+                    continue
+                stack.pop()
+                heaviest = max(prereqs, key=costs.get) if prereqs else None
+                costs[top] = self._targets[top][1] + costs.get(heaviest, 0)
+                nexts[top] = heaviest
+        path = []
+        target = max(costs, key=costs.get) if costs else None
+        while target is not None:
+            path.append((target, self._targets[target][1]))
+            target = nexts[target]
+        return path
+
+
+class TestRunner:
+    """
+    Run test binaries concurrently in their workspaces. The tests which took
+    the longest time last time are started first, so a few slow tests don't
+    run last, and a new test is assumed to be slow.
+    """
+
+    def __init__(self, jobs=1, path='.biu'):
+        self._jobs = max(1, jobs)
+        self._path = os.path.join(path, 'tests')
+        self._durations = {}
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                self._durations = json.load(f)
+
+    def _finish(self, target, status, output, duration):
+        output.seek(0)
+        relpath = os.path.relpath(target)
+        if status == 0:
+            say('[ PASS ] %s (%.2fs)', relpath, duration, color='green')
+        else:
+            say('[ FAIL ] %s (%.2fs)', relpath, duration, color='red')
+            say(output.read().rstrip())
+        output.close()
+
+    def run(self, tests):
+        """
+        Run `tests` of (binary, workspace), return the failed binaries.
+        """
+        # The last one is started first.
+        pending = sorted(tests, key=lambda test: self._durations.get(
+            test[0], float('inf')))
+        running = {}
+        failed = []
+        while pending or running:
+            while pending and len(running) < self._jobs:
+                target, cwd = pending.pop()
+                output = tempfile.TemporaryFile()
+                proc = subprocess.Popen([target], cwd=cwd, stdout=output,
+                                        stderr=subprocess.STDOUT)
+                # Keeps the Popen, otherwise it may reap the child by its
+                # `__del__` before `os.wait` does.
+                running[proc.pid] = (target, output, time.time(), proc)
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+            target, output, began, proc = running.pop(pid)
+            proc.returncode = status
+            duration = time.time() - began
+            self._durations[target] = duration
+            if status != 0:
+                failed.append(target)
+            self._finish(target, status, output, duration)
+        with open(self._path, 'w') as f:
+            json.dump(self._durations, f)
+        return sorted(failed)
+
+
+class Inotify:
+    """
+    A minimal binding of the inotify(7) API of Linux through `ctypes`.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError('inotify is unsupported on this platform')
+        self._libc = libc
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self._dirs = {}
+        self._wds = {}
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self._dirs[wd] = path
+        self._wds[path] = wd
+
+    def watching(self, path):
+        """
+        Whether `path` is watched still, a watch is removed once its
+        directory is deleted.
+        """
+        return path in self._wds
+
+    def read(self, timeout=None):
+        """
+        Return a list of (path, mask) which were reported within `timeout`.
+        """
+        rlist, _, _ = select.select([self._fd], [], [], timeout)
+        if not rlist:
+            return []
+        buf = os.read(self._fd, 1 << 16)
+        events = []
+        i = 0
+        while i < len(buf):
+            wd, mask, _, size = struct.unpack_from('iIII', buf, i)
+            name = buf[i + 16:i + 16 + size].rstrip('\0')
+            i += 16 + size
+            if mask & self.IN_IGNORED:
+                path = self._dirs.pop(wd, None)
+                # The directory may be created again and watched by another
+                # wd meanwhile.
+                if self._wds.get(path) == wd:
+                    del self._wds[path]
+            elif wd in self._dirs:
+                events.append((os.path.join(self._dirs[wd], name), mask))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class Watcher:
+    """
+    Watch a workspace and its SUBMODULE workspaces, and keep their Makefiles
+    up to date by applying file changes to the in-memory include graphs.
+    """
+
+    MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_DELETE | \
+        Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+
+    def __init__(self, biu, pool=None, generator='make', jobs=1, delay=0.1):
+        self._biu = biu
+        self._pool = pool
+        self._generator = generator
+        self._jobs = jobs
+        self._delay = delay
+        self._graphs = {}
+        self._inotify = Inotify()
+
+    def _watch(self, workspace):
+        skips = set(self._biu.derived_paths())
+        for root, dirs, _ in os.walk(workspace):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and
+                       not (root == workspace and d in skips)]
+            if not self._inotify.watching(root):
+                self._inotify.add_watch(root, self.MASK)
+
+    def _ignored(self, path):
+        name = os.path.basename(path)
+        return name.startswith('.') or name.endswith('~') or \
+            name in ('Makefile', 'build.ninja', 'compile_commands.json') or \
+            name.endswith(('.pb.h', '.pb.cc'))
+
+    def _generate(self):
+        for module in self._biu.generate(self._pool, self._graphs,
+                                         self._generator, jobs=self._jobs):
+            self._watch(module.workspace())
+        say('watching file changes, press Ctrl+C to stop.', color='yellow')
+
+    def run(self):
+        try:
+            self._generate()
+            while True:
+                events = self._inotify.read()
+                # Coalesces a burst of events, eg: saving by an editor.
+                time.sleep(self._delay)
+                events += self._inotify.read(0)
+
+                changed = set()
+                structural = False
+                for path, mask in events:
+                    if mask & Inotify.IN_ISDIR:
+                        if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                            self._watch(path)
+                        structural = True
+                    elif not self._ignored(path):
+                        changed.add(path)
+                        if not mask & Inotify.IN_CLOSE_WRITE:
+                            structural = True
+                if not changed and not structural:
+                    continue
+
+                say('=' * 60)
+                for path in sorted(changed):
+                    say('changed: %s', path, color='green')
+                for graph in self._graphs.itervalues():
+                    graph.invalidate(changed, structural)
+                self._generate()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for graph in self._graphs.itervalues():
+                graph.close()
+            self._inotify.close()
+
+
+class ModuleSummary:
+    """
+    The summary of a module generated by a worker process, which is sent to
+    the parent instead of the module itself.
+    """
+
+    def __init__(self, module):
+        self._workspace = module.workspace()
+        self._sub_modules = module.sub_modules()
+        self._proto_srcs = module.proto_srcs()
+        self._cache = module.cache()
+
+    def workspace(self):
+        return self._workspace
+
+    def sub_modules(self):
+        return self._sub_modules
+
+    def proto_srcs(self):
+        return self._proto_srcs
+
+    def cache(self):
+        return self._cache
+
+
+class SubModuleRecorder:
+    """
+    A stand-in of `Module` which records the workspaces declared by SUBMODULE
+    and ignores all of other calls of `api`.
+    """
+
+    def __init__(self, workspace):
+        self._workspace = workspace
+        self._workspaces = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def add_sub_module(self, workspace, libs):
+        self._workspaces.append(
+            os.path.abspath(os.path.join(self._workspace, workspace)))
+
+    def workspaces(self):
+        return self._workspaces
+
+
+def generate_module(args, graphs=None):
+    """
+    Generate a submodule in a worker process. The include graph is kept in
+    `graphs` if given, in which case it runs in the watching process. Paths
+    are resolved against the workspace of the submodule, so the current
+    directory of the process is never changed.
+    """
+    biu, workspace, generator, jobs, profile = args
+    if graphs is None:
+        # A worker outlives a generation, in which files may be changed.
+        filesystem.reset()
+    if profile:
+        profiler.enable()
+    module = biu._load(workspace, graphs=graphs, jobs=jobs)
+    # A subninja runs in the top workspace, so its paths must be rebased
+    # onto its own workspace.
+    module.build(biu._generators[generator], generator, workspace)
+    return ModuleSummary(module), profiler.take()
+
+
+class Scheduler:
+    """
+    Generate the submodules of a workspace DAG by a pool of workers. A module
+    is started by the callback of the last submodule it depends on, so this
+    process is free to generate the top module meanwhile.
+    """
+
+    def __init__(self, biu, dag, pool, generator, jobs):
+        self._biu = biu
+        self._dag = dag
+        self._subs = dag.keys()[:-1]
+        self._workers = pool or multiprocessing.Pool(
+            min(len(self._subs), multiprocessing.cpu_count()))
+        self._private = pool is None
+        self._generator = generator
+        self._jobs = jobs
+        self._lock = threading.Lock()
+        self._pending = list(self._subs)
+        self._results = {}
+        self._done = {}
+
+    def _start(self):
+        # Called with the lock held.
+        for workspace in [workspace for workspace in self._pending
+                          if all(sub in self._done
+                                 for sub in self._dag[workspace])]:
+            self._pending.remove(workspace)
+            args = (self._biu, workspace, self._generator, self._jobs,
+                    profiler.enabled())
+            self._results[workspace] = self._workers.apply_async(
+                generate_module, [args],
+                callback=lambda result, workspace=workspace:
+                self._finish(workspace, result))
+
+    def _finish(self, workspace, result):
+        # Called by the result thread of the pool.
+        module, events = result
+        with self._lock:
+            profiler.merge(events)
+            self._done[workspace] = module
+            self._start()
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def wait(self):
+        """
+        Wait for all of submodules, return their summaries in the order of
+        the DAG. The error of a failed submodule is raised again.
+        """
+        while True:
+            with self._lock:
+                if len(self._done) == len(self._subs):
+                    break
+                for result in self._results.itervalues():
+                    if result.ready() and not result.successful():
+                        result.get()
+            time.sleep(0.01)
+        if self._private:
+            self._private = False
+            self._workers.close()
+            self._workers.join()
+        return [self._done[workspace] for workspace in self._subs]
+
+
 class BiuBiu:
     """
     Collect all of rules and generate a makefile file.
@@ -817,6 +3359,8 @@ class BiuBiu:
         self._output_path = 'output'
         self._modules_path = os.path.join(self._build_path, 'modules')
         self._pbsrc_path = os.path.join(self._build_path, 'protos')
+        self._generators = {'make': 'Makefile', 'ninja': 'build.ninja',
+                            'flat': 'Makefile'}
 
     def _write_modules(self, workspaces):
         with open(self._modules_path, 'w') as f:
@@ -830,37 +3374,326 @@ class BiuBiu:
                 f.write(line)
                 f.write('\n')
 
-    def build(self):
-        say('=' * 60)
-
-        pwd = os.getcwd()
-        workspace = pwd
-        major = Module(workspace, self._build_path, self._output_path)
-        execfile(os.path.join(workspace, 'BUILD'), api(major))
-        major.build('Makefile')
-
-        module_paths = [pwd]
-        pbsrc_paths = list(major.proto_srcs())
-        for name, workspace, _ in major.sub_modules():
-            os.chdir(workspace)
-            module = Module(workspace, self._build_path, self._output_path)
+    def derived_paths(self):
+        return self._build_path, self._output_path
+
+    def _load(self, workspace, pool=None, graphs=None, jobs=1):
+        graph = None
+        if graphs is not None:
+            # Keeps the include graph in memory among generations.
+            graph = graphs.get(workspace)
+            if graph is None:
+                graph = IncludeGraph(
+                    ScanCache(os.path.join(workspace, self._build_path)),
+                    pool, workspace)
+                graphs[workspace] = graph
+        module = Module(workspace, self._build_path, self._output_path,
+                        pool, graph, jobs)
+        with profiler.phase('BUILD', module=module.name()):
             execfile(os.path.join(workspace, 'BUILD'), api(module))
-            module.build('Makefile')
-            os.chdir(pwd)
-            module_paths.append(workspace)
-            pbsrc_paths += module.proto_srcs()
-
-        self._write_lines(self._modules_path, module_paths)
-        self._write_lines(self._pbsrc_path, pbsrc_paths)
+        return module
+
+    def _sub_workspaces(self, workspace):
+        # Evaluates BUILD by the real api against a recorder, which is cheap
+        # and independent of the current directory.
+        recorder = SubModuleRecorder(workspace)
+        execfile(os.path.join(workspace, 'BUILD'), api(recorder))
+        return recorder.workspaces()
+
+    def _workspaces(self, top):
+        """
+        Return all of workspaces reachable from `top` by SUBMODULE mapped to
+        their SUBMODULE workspaces, in which a workspace always precedes the
+        workspaces depending on it, and a workspace shared by several modules
+        appears once.
+        """
+        order = collections.OrderedDict()
+        visiting = set()
+
+        def visit(workspace, path):
+            if workspace in order:
+                return
+            if workspace in visiting:
+                cycle = path[path.index(workspace):] + [workspace]
+                say('SUBMODULE cycle: %s', ' -> '.join(cycle), color='red')
+                sys.exit(-1)
+            visiting.add(workspace)
+            subs = self._sub_workspaces(workspace)
+            for sub in subs:
+                visit(sub, path + [workspace])
+            visiting.discard(workspace)
+            order[workspace] = subs
+
+        visit(top, [])
+        return order
+
+    def generate(self, pool=None, graphs=None, generator='make',
+                 targets=None, jobs=1):
+        """
+        Generate the Makefiles (or ninja files) of current workspace and all
+        of submodules reachable from it, and return all of modules. The
+        submodules are generated by worker processes concurrently, a module
+        is started once all of its submodules are done, and current module
+        is analyzed by this process meanwhile. If `graphs` is given, all of
+        modules are generated in this process one by one, and their include
+        graphs are kept in it among generations. Only the artifacts named by
+        `targets` of current workspace are analyzed if given. Every artifact
+        links all of SUBMODULEs of its module, so all of submodules are
+        generated still. At most `jobs` processes are run by a module, eg:
+        batches of protos.
+        """
+        fname = self._generators[generator]
+        pwd = os.getcwd()
+        filesystem.reset()
+        dag = self._workspaces(pwd)
+        subs = dag.keys()[:-1]
+
+        done = []
+        wait = None
+        if graphs is not None:
+            # The include graphs live in this process while watching, so are
+            # the submodules generated.
+            for workspace in subs:
+                module, _ = generate_module(
+                    (self, workspace, generator, jobs, False), graphs)
+                done.append(module)
+        elif subs:
+            scheduler = Scheduler(self, dag, pool, generator, jobs)
+            scheduler.start()
+            wait = scheduler.wait
+        major = self._load(pwd, pool, graphs, jobs)
+        major.build(fname, generator, subs=subs, targets=targets, wait=wait)
+        if wait is not None:
+            done = wait()
+
+        modules = [major] + done
+
+        self._write_lines(self._modules_path,
+                          [module.workspace() for module in modules])
+        self._write_lines(self._pbsrc_path,
+                          [path for module in modules
+                           for path in module.proto_srcs()])
+        return modules
+
+    def _pool(self, options):
+        if options.jobs > 1:
+            return multiprocessing.Pool(options.jobs)
+        return None
+
+    def _check(self, options):
+        if options.generator not in self._generators:
+            say('option --generator: %s is unsupported', options.generator,
+                color='red')
+            sys.exit(-1)
+        # The stored rules are emitted as their make commands, which a ninja
+        # file can not take.
+        if getattr(options, 'targets', None) and \
+                options.generator == 'ninja':
+            say('option --generator: ninja can not generate only some '
+                'artifacts', color='red')
+            sys.exit(-1)
+
+    def build(self, options):
+        self._check(options)
+        say('=' * 60)
 
-        say('build makefile : Makefile')
+        if options.profile:
+            profiler.enable()
+        pool = self._pool(options)
+        with profiler.phase('generate'):
+            self.generate(pool, generator=options.generator,
+                          targets=options.targets, jobs=options.jobs)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        tool = 'ninja' if options.generator == 'ninja' else 'make'
+        say('build %-9s: %s', 'makefile' if tool == 'make' else tool,
+            self._generators[options.generator])
         say('build output   : %s', os.path.join(self._output_path, ''))
         say('build date     : %s', time.strftime('%Y-%m-%d %H:%M:%S ',
                                                  time.localtime()))
 
-        say('\nplease execute the `make` command to make this project.',
+        if profiler.enabled():
+            trace = os.path.join(self._build_path, 'trace.json')
+            say('-' * 60)
+            profiler.summary()
+            profiler.dump(trace)
+            say('build trace    : %s', trace)
+
+        say('\nplease execute the `%s` command to make this project.', tool,
             color='yellow')
 
+    def watch(self, options):
+        self._check(options)
+        say('=' * 60)
+
+        pool = self._pool(options)
+        try:
+            Watcher(self, pool, options.generator, options.jobs).run()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _execute(self, options):
+        """
+        Generate and make all of modules directly, return the modules if
+        succeeded.
+        """
+        pool = self._pool(options)
+        modules = self.generate(pool, jobs=options.jobs)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        phony = lambda workspace: '<phony>' + workspace
+        artifacts = collections.defaultdict(list)
+        executor = Executor(options.jobs, options['keep-going'],
+                            self._build_path)
+        storages = []
+        owners = {}
+        for module in modules:
+            workspace = module.workspace()
+            subs = {name: sub_workspace
+                    for name, sub_workspace, _ in module.sub_modules()}
+            path = lambda p: os.path.normpath(os.path.join(workspace, p))
+            storage = Storage(os.path.join(workspace, self._build_path))
+            storages.append(storage)
+            for target, entry in sorted(storage.items()):
+                prereqs, command, is_obj = entry[:3]
+                signature = entry[3] if len(entry) > 3 else None
+                prereqs = [phony(subs[prereq]) if prereq in subs
+                           else path(prereq) for prereq in prereqs]
+                executor.add(path(target), prereqs, command, workspace,
+                             signature, module.cache())
+                owners[path(target)] = (storage, target)
+                if not is_obj:
+                    artifacts[workspace].append(path(target))
+        for module in modules:
+            for _, workspace, _ in module.sub_modules():
+                executor.add(phony(workspace), artifacts[workspace])
+
+        succeeded = executor.run()
+        stamps = collections.defaultdict(list)
+        for target, signature in executor.made().iteritems():
+            storage, name = owners[target]
+            stamps[storage].append((name, signature,
+                                    os.path.getmtime(target)))
+        for storage in storages:
+            storage.stamp(stamps[storage])
+            storage.close()
+        Telemetry(self._build_path).record(executor.graph(),
+                                           executor.timings(),
+                                           executor.stats())
+        if not succeeded:
+            say('\nmake failed.', color='red')
+            sys.exit(1)
+        return modules
+
+    def make(self, options):
+        say('=' * 60)
+        self._execute(options)
+        say('\nmake finished.', color='green')
+
+    def test(self, options):
+        say('=' * 60)
+        try:
+            index, count = [int(n) for n in options.shard.split('/')]
+            assert 0 <= index < count
+        except (ValueError, AssertionError):
+            say('option --shard: %s is not i/n, 0 <= i < n', options.shard,
+                color='red')
+            sys.exit(-1)
+
+        modules = self._execute(options)
+        tests = []
+        for module in modules:
+            workspace = module.workspace()
+            storage = Storage(os.path.join(workspace, self._build_path))
+            tests += [(os.path.normpath(os.path.join(workspace, target)),
+                       workspace)
+                      for target, _, kind in storage.artifacts()
+                      if kind == 'test']
+            storage.close()
+        # Every machine picks the same shard from the same tests regardless
+        # of the durations it has recorded.
+        tests = sorted(tests)[index::count]
+
+        say('=' * 60)
+        runner = TestRunner(options.jobs, self._build_path)
+        failed = runner.run(tests)
+        if failed:
+            say('\n%d of %d tests failed.', len(failed), len(tests),
+                color='red')
+            for target in failed:
+                say('  %s', os.path.relpath(target), color='red')
+            sys.exit(1)
+        say('\n%d tests passed.', len(tests), color='green')
+
+    def affected(self, options):
+        workspaces = [os.getcwd()]
+        if os.path.exists(self._modules_path):
+            with open(self._modules_path) as f:
+                workspaces = [line.strip() for line in f if line.strip()]
+        paths = [os.path.abspath(path) for path in options.files]
+        major, subs = workspaces[0], workspaces[1:]
+
+        affected = []
+        names = []
+        # Submodules are queried in dependency order, since an artifact
+        # depends on the name of a submodule which is affected.
+        for workspace in subs + [major]:
+            db = os.path.join(workspace, self._build_path, 'targets.db')
+            if not os.path.exists(db):
+                say('%s is not built, please execute `biu build` first.',
+                    workspace, color='red')
+                sys.exit(1)
+            changed = [os.path.relpath(path, workspace) for path in paths]
+            changed += names
+            storage = Storage(os.path.join(workspace, self._build_path))
+            if 'BUILD' in changed:
+                artifacts = storage.artifacts()
+            else:
+                artifacts = storage.affected(changed)
+            storage.close()
+            if artifacts and workspace != major:
+                names.append(os.path.basename(workspace))
+            affected += [(kind, name, os.path.join(workspace, target))
+                         for target, name, kind in artifacts]
+
+        for kind, name, target in affected:
+            sys.stdout.write('%-8s %-20s %s\n' %
+                             (kind, name, os.path.relpath(target)))
+
+    def report(self, options):
+        telemetry = Telemetry(self._build_path)
+        stats = telemetry.stats()
+        if not stats:
+            say('no timings, please execute `biu make` first.', color='red')
+            sys.exit(1)
+        relpath = lambda path: os.path.relpath(path)
+
+        say('slowest translation units:', color='yellow')
+        for target, duration, rss in telemetry.slowest(options.top):
+            say('  %8.2fs %8.1fMB  %s', duration, rss / 1024.0,
+                relpath(target))
+
+        path = telemetry.critical_path()
+        length = sum(duration for _, duration in path)
+        say('\ncritical path: %.2fs', length, color='yellow')
+        for target, duration in reversed(path):
+            if target.startswith('<phony>'):
+                continue
+            say('  %8.2fs  %s', duration, relpath(target))
+
+        say('\nlast make:', color='yellow')
+        say('  targets made  : %d with %d jobs', stats['made'], stats['jobs'])
+        say('  wall time     : %.2fs', stats['wall'])
+        say('  busy time     : %.2fs', stats['busy'])
+        if stats['wall'] > 0:
+            say('  parallelism   : %.2f', stats['busy'] / stats['wall'])
+
     def clean(self):
         modules = [os.getcwd()]
         if os.path.exists(self._modules_path):
@@ -873,11 +3706,13 @@ class BiuBiu:
                     if os.path.exists(fname):
                         os.remove(fname)
         for workspace in modules:
-            makefile_path = os.path.join(workspace, 'Makefile')
             build_path = os.path.join(workspace, self._build_path)
             output_path = os.path.join(workspace, self._output_path)
-            if os.path.exists(makefile_path):
-                os.remove(makefile_path)
+            for fname in ('Makefile', 'build.ninja', '.ninja_log',
+                          '.ninja_deps', 'compile_commands.json'):
+                path = os.path.join(workspace, fname)
+                if os.path.exists(path):
+                    os.remove(path)
             shutil.rmtree(build_path, True)
             shutil.rmtree(output_path, True)
 
@@ -895,9 +3730,54 @@ def do_args(argv):
     parser = ArgumentParser(os.path.basename(name), version=__version__)
     create_parser = OptionsParser()
     create_parser.add_option('--name',
-                             help='Artifact name. eg: app')
+                             help='Artifact name. eg: app', default='app')
+    build_parser = OptionsParser()
+    build_parser.add_option('--jobs', help='Number of analyzing processes',
+                            typo='int', default=1)
+    build_parser.add_option('--generator',
+                            help='Generator: make, flat or ninja',
+                            default='make')
+    build_parser.add_option('--profile', help='Profile the phases of build',
+                            typo='bool', default=False)
+    build_parser.add_positional('targets', help='Artifacts to be generated, '
+                                'all of artifacts by default')
     parser.add_command('create', 'Create BUILD file', create_parser)
-    parser.add_command('build', 'Build project and generate a makefile', None)
+    parser.add_command('build', 'Build project and generate a makefile',
+                       build_parser)
+    watch_parser = OptionsParser()
+    watch_parser.add_option('--jobs', help='Number of analyzing processes',
+                            typo='int', default=1)
+    watch_parser.add_option('--generator',
+                            help='Generator: make, flat or ninja',
+                            default='make')
+    parser.add_command('watch', 'Watch file changes and keep the makefile '
+                       'up to date', watch_parser)
+    make_parser = OptionsParser()
+    make_parser.add_option('--jobs', help='Number of parallel jobs',
+                           typo='int', default=multiprocessing.cpu_count(),
+                           alias='-j')
+    make_parser.add_option('--keep-going', help='Keep going when some '
+                           'targets failed', typo='bool', default=False)
+    parser.add_command('make', 'Build project and make it directly',
+                       make_parser)
+    affected_parser = OptionsParser()
+    affected_parser.add_positional('files', help='Changed files')
+    parser.add_command('affected', 'Show the artifacts affected by files',
+                       affected_parser)
+    test_parser = OptionsParser()
+    test_parser.add_option('--jobs', help='Number of parallel jobs',
+                           typo='int', default=multiprocessing.cpu_count(),
+                           alias='-j')
+    test_parser.add_option('--keep-going', help='Keep going when some '
+                           'targets failed', typo='bool', default=False)
+    test_parser.add_option('--shard', help='Run the i-th of n shards of '
+                           'tests. eg: 0/4', default='0/1')
+    parser.add_command('test', 'Build project and run tests', test_parser)
+    report_parser = OptionsParser()
+    report_parser.add_option('--top', help='Number of the slowest units',
+                             typo='int', default=10)
+    parser.add_command('report', 'Report the timings of the last make',
+                       report_parser)
     parser.add_command('clean', 'Clean this project', None)
     command, options = parser.parse(args)
     return command, options
@@ -910,7 +3790,17 @@ def main(args):
     if command == 'create':
         biu.create(options)
     elif command == 'build':
-        biu.build()
+        biu.build(options)
+    elif command == 'make':
+        biu.make(options)
+    elif command == 'watch':
+        biu.watch(options)
+    elif command == 'test':
+        biu.test(options)
+    elif command == 'affected':
+        biu.affected(options)
+    elif command == 'report':
+        biu.report(options)
     elif command == 'clean':
         biu.clean()
 
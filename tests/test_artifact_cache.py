@@ -0,0 +1,62 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _path(self, name):
+        return os.path.join(self._tmp, name)
+
+    def _write(self, name, content):
+        with open(self._path(name), 'w') as f:
+            f.write(content)
+
+    def _read(self, name):
+        with open(self._path(name)) as f:
+            return f.read()
+
+    def test_restore(self):
+        cache = biubiu.ArtifactCache(self._path('cache'))
+        self._write('a.o', 'object')
+        os.chmod(self._path('a.o'), 0o755)
+        cache.put('k1', self._path('a.o'))
+        self.assertFalse(cache.get('k2', self._path('out/b.o')))
+        self.assertTrue(cache.get('k1', self._path('out/b.o')))
+        self.assertEqual(self._read('out/b.o'), 'object')
+        self.assertEqual(os.stat(self._path('out/b.o')).st_mode & 0o777,
+                         0o755)
+        # An entry is never rewritten by another target.
+        self._write('c.o', 'other')
+        cache.put('k1', self._path('c.o'))
+        self.assertTrue(cache.get('k1', self._path('c.o')))
+        self.assertEqual(self._read('c.o'), 'object')
+
+    def test_evict(self):
+        cache = biubiu.ArtifactCache(self._path('cache'), size='10')
+        for key, mtime in (('k1', 100), ('k2', 200)):
+            self._write(key, key * 3)
+            cache.put(key, self._path(key))
+            os.utime(cache._entry(key), (mtime, mtime))
+        # Restoring an entry makes it the most recently used one.
+        self.assertTrue(cache.get('k1', self._path('a.o')))
+        cache.evict()
+        self.assertTrue(os.path.exists(cache._entry('k1')))
+        self.assertFalse(os.path.exists(cache._entry('k2')))
+        self.assertEqual(biubiu.ArtifactCache('', '1.5K')._size, 1536)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def test_many_jobs(self):
+        executor = biubiu.Executor(jobs=8)
+        for i in range(200):
+            executor.add('target%d' % i, [], 'true', self._tmp)
+        self.assertTrue(executor.run())
+        self.assertEqual(executor.stats()['made'], 200)
+
+    def test_order(self):
+        a, b, log = [os.path.join(self._tmp, name) for name in 'abl']
+        executor = biubiu.Executor(jobs=4)
+        executor.add(b, [a], 'echo b >> l && touch b', self._tmp)
+        executor.add(a, [], 'echo a >> l && touch a', self._tmp)
+        self.assertTrue(executor.run())
+        with open(log) as f:
+            self.assertEqual(f.read().split(), ['a', 'b'])
+
+    def test_failure(self):
+        a, b = [os.path.join(self._tmp, name) for name in 'ab']
+        executor = biubiu.Executor(jobs=2)
+        executor.add(a, [], 'false', self._tmp)
+        executor.add(b, [a], 'true', self._tmp)
+        self.assertFalse(executor.run())
+        self.assertNotIn(b, executor.timings())
+
+    def test_same_content(self):
+        source, obj, link, log = [os.path.join(self._tmp, name)
+                                  for name in ('s', 'o', 'l', 'log')]
+        path = os.path.join(self._tmp, '.biu')
+        os.mkdir(path)
+
+        def run(content, later):
+            with open(source, 'w') as f:
+                f.write(content)
+            mtime = time.time() + later
+            os.utime(source, (mtime, mtime))
+            executor = biubiu.Executor(path=path)
+            executor.add(obj, [source], 'cut -c1 s > o', self._tmp)
+            executor.add(link, [obj], 'cp o l && echo l >> log', self._tmp)
+            self.assertTrue(executor.run())
+            with open(log) as f:
+                return len(f.read().split())
+
+        self.assertEqual(run('ab', 10), 1)
+        # The object is made again with the same content.
+        self.assertEqual(run('ac', 20), 1)
+        self.assertEqual(run('bc', 30), 2)
+
+    def test_alias(self):
+        parser = biubiu.OptionsParser()
+        parser.add_option('--jobs', help='Number of parallel jobs',
+                          typo='int', default=1, alias='-j')
+        self.assertEqual(parser.parse_args(['-j', '8']).jobs, 8)
+        self.assertEqual(parser.parse_args(['--jobs', '4']).jobs, 4)
+        self.assertIn('-j, --jobs', parser.help())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class FileSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        for path in ('src/a.cc', 'src/b.cc', 'src/.hidden.cc', 'src/c.h',
+                     'src/sub/d.cc', 'src/sub/deep/e.cc', 'src/.dot/f.cc',
+                     'include/g.h', 'top.cc'):
+            self._write(path)
+        self._filesystem = biubiu.FileSystem()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path):
+        path = os.path.join(self._tmp, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def test_glob(self):
+        patterns = ['src/*.cc', 'src/.*', 'src/.*.cc', 'src/*', 'src/*/',
+                    'src/*/*.cc', 'src/**/*.cc', '*/*.h', 'src/[ab].cc',
+                    'src/?.cc', 'src/a.cc', 'src/z.cc', 'src/', 'src/sub/',
+                    'missing/*.cc', 'missing/', 'src/a.cc/*', '*',
+                    'src/.dot/*', 'src/*/deep/*', 'src//*.cc']
+        for pattern in patterns:
+            pattern = os.path.join(self._tmp, pattern)
+            self.assertEqual(sorted(self._filesystem.glob(pattern)),
+                             sorted(glob.glob(pattern)), pattern)
+
+    def test_exists(self):
+        for path in ('src/a.cc', 'src/sub/../b.cc', 'src/./c.h', 'src/',
+                     'src/sub', 'src/.hidden.cc', 'src/z.h', 'missing/a.h',
+                     'src/a.cc/x.h', '.', 'include/g.h'):
+            path = os.path.join(self._tmp, path)
+            self.assertEqual(self._filesystem.exists(path),
+                             os.path.exists(path), path)
+
+    def test_globs(self):
+        self.assertEqual(sorted(biubiu.globs(['src/*.cc', 'top.cc'],
+                                             self._tmp)),
+                         ['src/a.cc', 'src/b.cc', 'top.cc'])
+
+    def test_invalidate(self):
+        pattern = os.path.join(self._tmp, 'src', '*.h')
+        self.assertEqual(len(self._filesystem.glob(pattern)), 1)
+        self._write('src/x.h')
+        # The listing is stale until it is invalidated.
+        self.assertEqual(len(self._filesystem.glob(pattern)), 1)
+        self.assertFalse(self._filesystem.exists(
+            os.path.join(self._tmp, 'src', 'x.h')))
+        self._filesystem.invalidate(os.path.join(self._tmp, 'src'))
+        self.assertEqual(len(self._filesystem.glob(pattern)), 2)
+        self.assertTrue(self._filesystem.exists(
+            os.path.join(self._tmp, 'src', 'x.h')))
+        self._filesystem.reset()
+        self._write('src/y.h')
+        self.assertEqual(len(self._filesystem.glob(pattern)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
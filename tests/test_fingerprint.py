@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, '.biu')
+        os.mkdir(self._path)
+        for name in ('BUILD', 'a.cc'):
+            self._write(name, name)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path, content):
+        with open(os.path.join(self._tmp, path), 'w') as f:
+            f.write(content)
+
+    def _fingerprint(self):
+        return biubiu.Fingerprint(self._path, self._tmp)
+
+    def test_match(self):
+        self.assertFalse(self._fingerprint().match('state'))
+        self._fingerprint().save('state', {'sub': 's1'}, ['BUILD', 'a.cc'])
+
+        fingerprint = self._fingerprint()
+        self.assertTrue(fingerprint.match('state'))
+        self.assertFalse(fingerprint.match('other state'))
+        self.assertTrue(fingerprint.match_subs({'sub': 's1'}))
+        self.assertFalse(fingerprint.match_subs({'sub': 's2'}))
+
+        # A dependency is changed or removed.
+        self._write('a.cc', 'changed')
+        self.assertFalse(self._fingerprint().match('state'))
+        os.remove(os.path.join(self._tmp, 'a.cc'))
+        self.assertFalse(self._fingerprint().match('state'))
+
+    def test_clear(self):
+        fingerprint = self._fingerprint()
+        fingerprint.save('state', {}, ['BUILD'])
+        fingerprint.clear()
+        self.assertFalse(fingerprint.match('state'))
+        self.assertFalse(self._fingerprint().match('state'))
+
+
+if __name__ == '__main__':
+    unittest.main()
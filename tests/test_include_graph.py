@@ -0,0 +1,171 @@
+import collections
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class IncludeGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        biubiu.filesystem.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path, *headers):
+        path = os.path.join(self._tmp, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(''.join('#include "%s"\n' % header for header in headers))
+
+    def _graph(self):
+        # Counts the expansions of each file.
+        graph = biubiu.IncludeGraph(root=self._tmp)
+        expand = graph._expand
+        counts = collections.Counter()
+
+        def counted(path, includes):
+            counts[path] += 1
+            return expand(path, includes)
+        graph._expand = counted
+        return graph, counts
+
+    def test_shared_headers(self):
+        headers = ['inc/h%d.h' % i for i in range(50)]
+        self._write('inc/common.h', 'h0.h')
+        for i, header in enumerate(headers):
+            self._write(header, *(['h%d.h' % (i + 1)] if i < 49 else []))
+        sources = ['src/s%d.cc' % i for i in range(100)]
+        for source in sources:
+            self._write(source, 'common.h', 'h49.h')
+
+        graph, counts = self._graph()
+        includes = ('inc/', 'src')
+        for source in sources:
+            self.assertEqual(graph.closure(source, includes),
+                             [source, 'inc/common.h'] + headers)
+        self.assertEqual(counts['inc/common.h'], 1)
+        self.assertEqual(set(counts[header] for header in headers), set([1]))
+        # The closure of a header is memoized as well.
+        self.assertEqual(graph.closure('inc/h48.h', includes),
+                         ['inc/h48.h', 'inc/h49.h'])
+        self.assertEqual(counts['inc/h48.h'], 1)
+
+    def test_cycle(self):
+        self._write('a.h', 'b.h')
+        self._write('b.h', 'a.h', 'c.h')
+        self._write('c.h', 'c.h')
+        self._write('main.cc', 'b.h', 'a.h')
+
+        graph, counts = self._graph()
+        self.assertEqual(graph.closure('main.cc', ('',)),
+                         ['main.cc', 'b.h', 'a.h', 'c.h'])
+        self.assertEqual(graph.closure('a.h', ('',)), ['a.h', 'b.h', 'c.h'])
+        self.assertEqual(graph.closure('b.h', ('',)), ['b.h', 'a.h', 'c.h'])
+        self.assertEqual(graph.closure('c.h', ('',)), ['c.h'])
+        self.assertEqual(set(counts.values()), set([1]))
+
+    def test_invalidate(self):
+        self._write('a.h', 'b.h')
+        self._write('b.h')
+        self._write('c.h')
+        self._write('a.cc', 'a.h')
+        self._write('c.cc', 'c.h')
+
+        graph, counts = self._graph()
+        self.assertEqual(graph.closure('a.cc', ('',)), ['a.cc', 'a.h', 'b.h'])
+        self.assertEqual(graph.closure('c.cc', ('',)), ['c.cc', 'c.h'])
+        self._write('a.h', 'd.h')
+        graph.invalidate([os.path.join(self._tmp, 'a.h')])
+        self.assertEqual(graph.closure('a.cc', ('',)), ['a.cc', 'a.h'])
+        self.assertEqual(graph.closure('c.cc', ('',)), ['c.cc', 'c.h'])
+        # Only the closures containing the changed file are walked again.
+        self.assertEqual(counts['c.cc'], 1)
+        self.assertEqual(counts['a.h'], 2)
+
+        # A created file is resolved once the graph forgets resolutions.
+        self._write('d.h')
+        biubiu.filesystem.invalidate(self._tmp)
+        graph.invalidate([os.path.join(self._tmp, 'd.h')], structural=True)
+        self.assertEqual(graph.closure('a.cc', ('',)),
+                         ['a.cc', 'a.h', 'd.h'])
+
+    def _scans(self):
+        # Counts the files read by `scan`.
+        scan = biubiu.scan
+        scanned = []
+
+        def counted(path):
+            scanned.append(os.path.relpath(path, self._tmp))
+            return scan(path)
+        biubiu.scan = counted
+        self.addCleanup(setattr, biubiu, 'scan', scan)
+        return scanned
+
+    def _utime(self, path, mtime):
+        os.utime(os.path.join(self._tmp, path), (mtime, mtime))
+
+    def test_scan_cache(self):
+        self._write('a.h', 'b.h')
+        self._write('b.h')
+        self._write('a.cc', 'a.h')
+        for path in ('a.h', 'b.h', 'a.cc'):
+            self._utime(path, 1000)
+        scanned = self._scans()
+        path = os.path.join(self._tmp, '.biu')
+
+        def closure():
+            cache = biubiu.ScanCache(path)
+            graph = biubiu.IncludeGraph(cache, root=self._tmp)
+            try:
+                return graph.closure('a.cc', ('',)), graph.touched()
+            finally:
+                cache.close()
+
+        self.assertEqual(closure(), (['a.cc', 'a.h', 'b.h'], {}))
+        self.assertEqual(sorted(scanned), ['a.cc', 'a.h', 'b.h'])
+        # Nothing is read while the stats match.
+        del scanned[:]
+        self.assertEqual(closure(), (['a.cc', 'a.h', 'b.h'], {}))
+        self.assertEqual(scanned, [])
+        # A changed file is read again, and a touched one is reported.
+        self._write('a.h')
+        self._utime('a.h', 2000)
+        self._utime('a.cc', 2000)
+        self.assertEqual(closure(), (['a.cc', 'a.h'], {'a.cc': 1000}))
+        self.assertEqual(sorted(scanned), ['a.cc', 'a.h'])
+
+    def test_pool(self):
+        headers = ['inc/h%d.h' % i for i in range(20)]
+        for i, header in enumerate(headers):
+            self._write(header, *['h%d.h' % j for j in range(i + 1, 20, 3)])
+        sources = ['src/s%d.cc' % i for i in range(30)]
+        for i, source in enumerate(sources):
+            self._write(source, 'h%d.h' % (i % 20), 'missing.h')
+        includes = ('inc/', 'src')
+        pairs = [(source, includes) for source in sources]
+
+        pool = multiprocessing.Pool(2)
+        self.addCleanup(pool.terminate)
+        graphs = []
+        for each in (None, pool):
+            graph = biubiu.IncludeGraph(pool=each, root=self._tmp)
+            graph.prefetch(pairs)
+            graphs.append(dict((source, graph.closure(source, includes))
+                               for source in sources))
+        self.assertEqual(graphs[0], graphs[1])
+        self.assertEqual(graphs[0]['src/s0.cc'][:3],
+                         ['src/s0.cc', 'inc/h0.h', 'inc/h1.h'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import StringIO
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class ModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = os.path.realpath(tempfile.mkdtemp())
+        biubiu.filesystem.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path, content=''):
+        path = os.path.join(self._tmp, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _build(self, build, targets=None):
+        self._write('BUILD', build)
+        biubiu.filesystem.reset()
+        module = biubiu.Module(self._tmp)
+        execfile(os.path.join(self._tmp, 'BUILD'), biubiu.api(module))
+        module.build('Makefile', targets=targets)
+        return module
+
+    def _commands(self, module):
+        return {obj_rule.source(): obj_rule.command()
+                for artifact in module.artifacts()
+                for obj_rule in artifact.obj_rules()}
+
+    def test_pch(self):
+        self._write('src/common.h', '#include "base.h"\n')
+        self._write('src/base.h')
+        for name in 'abc':
+            self._write('src/%s.cc' % name, '#include "common.h"\n')
+        self._write('src/d.cc', '#include "base.h"\n')
+        module = self._build("PCH(threshold=0.5)\n"
+                             "BINARY('app', sources=['src/*.cc'])\n")
+        commands = self._commands(module)
+        pchs = [source for source in commands
+                if source.endswith('pch.h')]
+        self.assertEqual(len(pchs), 1)
+        for name in 'abc':
+            self.assertIn('-include ' + pchs[0],
+                          commands['src/%s.cc' % name])
+        # d.cc doesn't include common.h, so it is not included by force.
+        self.assertNotIn('-include', commands['src/d.cc'])
+        with open(os.path.join(self._tmp, pchs[0])) as f:
+            self.assertIn('common.h', f.read())
+
+    def test_pch_unity(self):
+        self._write('src/common.h')
+        for name in 'abc':
+            self._write('src/%s.cc' % name, '#include "common.h"\n')
+        self._write('src/d.cc')
+        module = self._build("PCH(['src/common.h'])\n"
+                             "BINARY('app', sources=['src/a.cc', 'src/b.cc', "
+                             "'src/c.cc', 'src/d.cc'], unity=2)\n")
+        commands = [command for source, command in
+                    sorted(self._commands(module).iteritems())
+                    if 'unity' in source]
+        self.assertEqual(len(commands), 2)
+        self.assertIn('-include', commands[0])
+        self.assertNotIn('-include', commands[1])
+
+    def test_select(self):
+        for name in 'ab':
+            self._write('%s/%s.cc' % (name, name))
+        build = ("BINARY('a', sources=['a/*.cc'])\n"
+                 "BINARY('b', sources=['b/*.cc'])\n")
+        self._build(build)
+        self._write('a/c.cc')
+        self._write('b/c.cc')
+        module = self._build(build, targets=['a'])
+        self.assertEqual(sorted(self._commands(module)),
+                         ['a/a.cc', 'a/c.cc', 'b/b.cc'])
+        self.assertIsInstance(module.artifacts()[1], biubiu.StoredArtifact)
+        with open(os.path.join(self._tmp, 'Makefile')) as f:
+            makefile = f.read()
+        self.assertIn('b/b.cc.o', makefile)
+        self.assertNotIn('b/c.cc', makefile)
+        self.assertFalse(os.path.exists(
+            os.path.join(self._tmp, '.biu', 'fingerprint')))
+        # The next full build analyzes all of artifacts again.
+        module = self._build(build)
+        self.assertIn('b/c.cc', self._commands(module))
+
+    def _utime(self, path, mtime):
+        os.utime(os.path.join(self._tmp, path), (mtime, mtime))
+
+    def _make(self, *args):
+        return subprocess.check_output(('make',) + args, cwd=self._tmp,
+                                       stderr=subprocess.STDOUT)
+
+    def test_touched_header(self):
+        # Made by `make` only, the object is kept when its header is touched.
+        self._write('src/a.h', 'int a();\n')
+        self._write('src/main.cc', '#include "a.h"\nint main() {}\n')
+        build = "BINARY('app', includes=['src/'], sources=['src/*.cc'])\n"
+        now = time.time()
+        for path in ('src/a.h', 'src/main.cc'):
+            self._utime(path, now - 100)
+        self._build(build)
+        self._make()
+        self.assertNotIn('g++', self._make('-n'))
+        # Made long ago, then the header is touched.
+        for root, _, files in os.walk(os.path.join(self._tmp, 'output')):
+            for name in files:
+                self._utime(os.path.join(root, name), now - 50)
+        self._utime('src/a.h', now - 20)
+        self.assertIn('g++', self._make('-n'))
+        self._build(build)
+        self.assertNotIn('g++', self._make('-n'))
+
+    def test_restore(self):
+        self._write('src/main.cc', 'int main() {}\n')
+        build = ("CACHE('%s')\n"
+                 "BINARY('app', sources=['src/*.cc'])\n" %
+                 os.path.join(self._tmp, 'cache'))
+        self._build(build)
+        self._make()
+        # Stored to the cache once they are known to be built from their
+        # signatures by the next generation.
+        self._build(build + '# changed\n')
+        shutil.rmtree(os.path.join(self._tmp, 'output'))
+        shutil.rmtree(os.path.join(self._tmp, '.biu'))
+        os.remove(os.path.join(self._tmp, 'Makefile'))
+        self._build(build)
+        self.assertNotIn('g++', self._make('-n'))
+
+    def test_shared(self):
+        self._write('src/f.cc')
+        module = self._build("LIBRARY('libf.so', sources=['src/*.cc'])\n")
+        rule = module.artifacts()[0].rule()
+        self.assertTrue(rule.target().endswith('/lib/libf.so'))
+        self.assertIn('-o %s -shared -fPIC ' % rule.target(), rule.command())
+
+    def test_affected(self):
+        self._write('src/f.cc')
+        self._build("LIBRARY('libf.a', sources=['src/f.cc'])\n"
+                    "LIBRARY('libf.so', sources=['src/f.cc'])\n"
+                    "BINARY('app', sources=['src/f.cc'])\n"
+                    "TEST('app_test', sources=['src/f.cc'])\n")
+        options = collections.namedtuple('Options', 'files')(['src/f.cc'])
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            os.chdir(self._tmp)
+            biubiu.BiuBiu().affected(options)
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+        kinds = sorted(line.split()[:2] for line in lines)
+        self.assertEqual(kinds, [['binary', 'app'], ['library', 'libf.a'],
+                                 ['shared', 'libf.so'],
+                                 ['test', 'app_test']])
+        # The kinds fit in their column.
+        self.assertEqual(set(line[8] for line in lines), set([' ']))
+
+    def test_shared_objects(self):
+        for name in ('common', 'a', 'b', 'c'):
+            self._write('src/%s.cc' % name)
+        module = self._build(
+            "BINARY('a', sources=['src/common.cc', 'src/a.cc'])\n"
+            "BINARY('b', sources=['src/common.cc', 'src/b.cc'])\n"
+            "BINARY('c', sources=['src/common.cc', 'src/c.cc'], "
+            "cxxflags='-O3')\n")
+        a, b, c = [artifact.rule().prereqs()
+                   for artifact in module.artifacts()]
+        # Compiled once for a and b, but again for c by other flags.
+        self.assertEqual(a[0], b[0])
+        self.assertNotEqual(a[0], c[0])
+        self.assertEqual(len(set(a + b + c)), 5)
+        targets = [obj_rule.target() for artifact in module.artifacts()
+                   for obj_rule in artifact.obj_rules()]
+        self.assertEqual(sorted(targets), sorted(set(a + b + c)))
+        with open(os.path.join(self._tmp, 'Makefile')) as f:
+            self.assertEqual(f.read().count('\n%s : ' % a[0]), 1)
+
+    def _compdb(self):
+        with open(os.path.join(self._tmp, 'compile_commands.json')) as f:
+            return {entry['file']: entry for entry in json.load(f)}
+
+    def test_compdb(self):
+        for name in 'abc':
+            self._write('src/%s.cc' % name)
+        self._write('src/d.c')
+        self._build("BINARY('app', sources=['src/*.cc', 'src/*.c'])\n")
+        entries = self._compdb()
+        self.assertEqual(sorted(entries),
+                         ['src/a.cc', 'src/b.cc', 'src/c.cc', 'src/d.c'])
+        self.assertEqual(entries['src/a.cc']['directory'], self._tmp)
+        self.assertTrue(entries['src/d.c']['command'].startswith('gcc '))
+        self.assertTrue(entries['src/a.cc']['command'].endswith(' src/a.cc'))
+
+    def test_compdb_unity(self):
+        for name in 'abc':
+            self._write('src/%s.cc' % name)
+        self._build("BINARY('app', sources=['src/a.cc', 'src/b.cc', "
+                    "'src/c.cc'], cxxflags='-DUNITY', unity=2)\n")
+        # The members are written instead of the unity sources.
+        entries = self._compdb()
+        self.assertEqual(sorted(entries), ['src/a.cc', 'src/b.cc', 'src/c.cc'])
+        self.assertEqual(entries['src/a.cc']['output'],
+                         entries['src/b.cc']['output'])
+        self.assertNotEqual(entries['src/a.cc']['output'],
+                            entries['src/c.cc']['output'])
+        for name, entry in entries.iteritems():
+            self.assertIn('-DUNITY', entry['command'])
+            self.assertTrue(entry['command'].endswith(' ' + name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import StringIO
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def _record(self, pid):
+        profiler = biubiu.Profiler()
+        profiler.enable()
+        with profiler.phase('build', module=str(pid)):
+            with profiler.phase('prefetch', module=str(pid)):
+                profiler.count('reads')
+        events = profiler.take()
+        for event in events:
+            event['pid'] = pid
+        return events
+
+    def _summary(self, profiler):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            profiler.summary()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return [line.rstrip() for line in
+                output.replace('\033[0m', '').splitlines()[1:]]
+
+    def test_summary(self):
+        pid = os.getpid()
+        profiler = biubiu.Profiler()
+        profiler.enable()
+        with profiler.phase('generate'):
+            # The workers ran meanwhile.
+            profiler.merge(self._record(pid + 2) + self._record(pid + 1))
+        names = [line[:36].rstrip() for line in self._summary(profiler)]
+        self.assertEqual(names, [
+            'generate',
+            'worker %d' % (pid + 1),
+            '  build [%d]' % (pid + 1),
+            '    prefetch [%d]' % (pid + 1),
+            'worker %d' % (pid + 2),
+            '  build [%d]' % (pid + 2),
+            '    prefetch [%d]' % (pid + 2),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
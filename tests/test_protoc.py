@@ -0,0 +1,90 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+# Writes the outputs of every proto like protoc, and logs its arguments.
+PROTOC = r'''#!/bin/sh
+echo "$@" >> protoc.log
+for arg; do
+    case $arg in --cpp_out=*) out=${arg#--cpp_out=};; esac
+done
+for arg; do
+    case $arg in *.proto)
+        name=$(basename ${arg%.proto})
+        cat $arg > $out/$name.pb.h
+        touch $out/$name.pb.cc;;
+    esac
+done
+'''
+
+
+class ProtocTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, '.biu')
+        os.mkdir(self._path)
+        self._protoc = os.path.join(self._tmp, 'protoc')
+        with open(self._protoc, 'w') as f:
+            f.write(PROTOC)
+        os.chmod(self._protoc, stat.S_IRWXU)
+        biubiu.filesystem.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path, content=''):
+        path = os.path.join(self._tmp, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _protoc_of(self, protos):
+        return biubiu.Protoc(self._protoc, protos, self._path, self._tmp)
+
+    def _log(self):
+        with open(os.path.join(self._tmp, 'protoc.log')) as f:
+            return f.read().splitlines()
+
+    def test_stale(self):
+        protos = ['a/x.proto', 'a/y.proto', 'b/z.proto']
+        self._write('a/x.proto', 'import "y.proto";\n')
+        self._write('a/y.proto')
+        self._write('b/z.proto')
+        protoc = self._protoc_of(protos)
+        self.assertEqual(protoc.stale(), protos)
+        protoc.run(protoc.stale(), 'test', jobs=1)
+        # A batch per directory.
+        self.assertEqual([[arg for arg in line.split()
+                           if arg.endswith('.proto')]
+                          for line in self._log()],
+                         [['a/x.proto', 'a/y.proto'], ['b/z.proto']])
+        with open(os.path.join(self._tmp, 'a/x.pb.h')) as f:
+            self.assertEqual(f.read(), 'import "y.proto";\n')
+
+        self.assertEqual(self._protoc_of(protos).stale(), [])
+        # A proto is stale once a proto it imports is changed.
+        self._write('a/y.proto', 'message Y {}\n')
+        self.assertEqual(self._protoc_of(protos).stale(),
+                         ['a/x.proto', 'a/y.proto'])
+
+    def test_missing_output(self):
+        self._write('a/x.proto')
+        protoc = self._protoc_of(['a/x.proto'])
+        protoc.run(protoc.stale(), 'test')
+        os.remove(os.path.join(self._tmp, 'a/x.pb.cc'))
+        biubiu.filesystem.reset()
+        self.assertEqual(self._protoc_of(['a/x.proto']).stale(),
+                         ['a/x.proto'])
+
+
+if __name__ == '__main__':
+    unittest.main()
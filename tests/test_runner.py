@@ -0,0 +1,38 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class TestRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _test(self, name, script):
+        path = os.path.join(self._tmp, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n%s\n' % script)
+        os.chmod(path, stat.S_IRWXU)
+        return path, self._tmp
+
+    def test_run(self):
+        tests = [self._test('fast', 'true'), self._test('slow', 'sleep 0.2')]
+        tests += [self._test('fail%d' % i, 'false') for i in range(20)]
+        runner = biubiu.TestRunner(jobs=4, path=self._tmp)
+        failed = runner.run(tests)
+        self.assertEqual(len(failed), 20)
+        self.assertTrue(os.path.exists(os.path.join(self._tmp, 'tests')))
+
+
+if __name__ == '__main__':
+    unittest.main()
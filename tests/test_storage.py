@@ -0,0 +1,187 @@
+import os
+import shelve
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, '.biu')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _storage(self):
+        return biubiu.Storage(self._path, self._tmp)
+
+    def _db(self):
+        return sqlite3.connect(os.path.join(self._path, 'targets.db'))
+
+    def test_rows(self):
+        storage = self._storage()
+        storage.set('a.o', ['a.cc', 'c.h'], 'cc a', True, 'sa')
+        storage.set('b.o', ['a.cc', 'c.h'], 'cc b', True, 'sb')
+        storage.set('app', ['a.o', 'b.o'], 'ld', False, 'sl', 'app', 'binary')
+        storage.save()
+
+        storage = self._storage()
+        self.assertEqual(storage.rows(), {
+            'a.o': (('a.cc', 'c.h'), 'cc a', True, 'sa', None, None),
+            'b.o': (('a.cc', 'c.h'), 'cc b', True, 'sb', None, None),
+            'app': (('a.o', 'b.o'), 'ld', False, 'sl', 'app', 'binary'),
+        })
+        self.assertEqual(storage.signature('b.o'), 'sb')
+        self.assertEqual(storage.artifacts(), [('app', 'app', 'binary')])
+        storage.close()
+        db = self._db()
+        # Identical lists of prereqs are stored once.
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM prereqs')
+                         .fetchone(), (2,))
+        self.assertEqual(db.execute('PRAGMA user_version').fetchone(),
+                         (biubiu.Storage.version,))
+        db.close()
+
+    def test_expired(self):
+        storage = self._storage()
+        storage.set('a.o', ['a.cc'], 'cc a', True, 'sa')
+        storage.set('b.o', ['b.cc'], 'cc b', True, 'sb')
+        storage.save()
+        storage = self._storage()
+        storage.set('a.o', ['a.cc'], 'cc a', True, 'sa')
+        storage.save()
+        storage = self._storage()
+        self.assertEqual(storage.rows().keys(), ['a.o'])
+        storage.close()
+        db = self._db()
+        self.assertEqual(db.execute('SELECT paths FROM prereqs').fetchall(),
+                         [('a.cc',)])
+        db.close()
+
+    def _touch(self, *paths):
+        for path in paths:
+            with open(os.path.join(self._tmp, path), 'w') as f:
+                f.write(path)
+
+    def _utime(self, path, mtime):
+        os.utime(os.path.join(self._tmp, path), (mtime, mtime))
+
+    def _mtime(self, path):
+        return os.path.getmtime(os.path.join(self._tmp, path))
+
+    def _set(self, storage, obj_signature, signature):
+        storage.set('a.o', ['a.cc'], 'cc a', True, obj_signature)
+        storage.set('app', ['a.o'], 'ld', False, signature, 'app', 'binary')
+
+    def test_stamps(self):
+        self._touch('a.cc', 'a.o', 'app')
+        for path, mtime in (('a.cc', 100), ('a.o', 200), ('app', 300)):
+            self._utime(path, mtime)
+        storage = self._storage()
+        self._set(storage, 'sa', 'sl')
+        storage.save()
+        # Made by `make` from the signatures.
+        storage = self._storage()
+        storage.stamp([('a.o', 'sa', 200.0), ('app', 'sl', 300.0)])
+        storage.close()
+
+        # The source is touched, but its content is unchanged.
+        self._utime('a.cc', 400)
+        storage = self._storage()
+        self._set(storage, 'sa', 'sl')
+        storage.save(touched={'a.cc': 100.0})
+        self.assertGreater(self._mtime('a.o'), 400)
+        self.assertGreaterEqual(self._mtime('app'), self._mtime('a.o'))
+        storage = self._storage()
+        self.assertTrue(storage._stamped('a.o', 'sa', self._mtime('a.o')))
+        self.assertTrue(storage._stamped('app', 'sl', self._mtime('app')))
+        storage.close()
+
+        # The source is changed and `make` made the object from it, so it is
+        # kept and stamped with the new signature.
+        mtime = self._mtime('app')
+        self._utime('a.cc', mtime + 10)
+        self._utime('a.o', mtime + 20)
+        storage = self._storage()
+        self._set(storage, 'sb', 'sl2')
+        storage.save()
+        storage = self._storage()
+        self.assertTrue(storage._stamped('a.o', 'sb', self._mtime('a.o')))
+        self.assertTrue(os.path.exists(os.path.join(self._tmp, 'app')))
+        storage.close()
+
+    def test_changed_signature(self):
+        self._touch('a.cc', 'a.o', 'app')
+        storage = self._storage()
+        storage.set('a.o', ['a.cc'], 'cc a', True, 'sa')
+        storage.set('app', ['a.o'], 'ld', False, 'sl', 'app', 'binary')
+        storage.save()
+        os.utime(os.path.join(self._tmp, 'a.cc'), (1 << 31, 1 << 31))
+        storage = self._storage()
+        storage.set('a.o', ['a.cc'], 'cc a', True, 'sa2')
+        storage.set('app', ['a.o'], 'ld', False, 'sl2', 'app', 'binary')
+        storage.save()
+        # The object is made again, the artifact is left to `make`.
+        self.assertFalse(os.path.exists(os.path.join(self._tmp, 'a.o')))
+        self.assertTrue(os.path.exists(os.path.join(self._tmp, 'app')))
+
+    def test_affected(self):
+        storage = self._storage()
+        storage.set('a.o', ['src/a.cc'], 'cc a', True, 'sa')
+        storage.set('b.o', ['src/b.cc'], 'cc b', True, 'sb')
+        storage.set('liba.a', ['a.o'], 'ar', False, 'sl', 'liba.a', 'library')
+        storage.set('app', ['b.o', 'liba.a'], 'ld', False, 'sp', 'app',
+                    'binary')
+        storage.set_includes({'src/a.cc': set(['src/a.h']),
+                              'src/a.h': set(['src/base.h']),
+                              'src/b.cc': set()})
+        storage.save()
+
+        storage = self._storage()
+        # Reached through the includes, the objects and the library.
+        self.assertEqual(storage.affected(['src/base.h']), [
+            ('app', 'app', 'binary'), ('liba.a', 'liba.a', 'library')])
+        self.assertEqual(storage.affected(['src/./b.cc']),
+                         [('app', 'app', 'binary')])
+        self.assertEqual(storage.affected(['src/c.h']), [])
+        storage.close()
+
+    def test_old_version(self):
+        os.mkdir(self._path)
+        db = self._db()
+        db.executescript('CREATE TABLE targets (target TEXT, data BLOB);'
+                         'PRAGMA user_version = 1;')
+        db.close()
+        storage = self._storage()
+        self.assertEqual(storage.rows(), {})
+        storage.set('a.o', ['a.cc'], 'cc a', True, 'sa')
+        storage.save()
+        self.assertEqual(self._storage().rows().keys(), ['a.o'])
+
+    def test_migrate(self):
+        os.mkdir(self._path)
+        old = shelve.open(os.path.join(self._path, 'targets'))
+        old['a.o'] = (['a.cc', 'a.h'], 'cc a', True, 'sa')
+        old['app'] = (['a.o'], 'ld', False)
+        old.close()
+
+        storage = self._storage()
+        self.assertEqual(storage.rows(), {
+            'a.o': (('a.cc', 'a.h'), 'cc a', True, 'sa', None, None),
+            'app': (('a.o',), 'ld', False, None, None, None),
+        })
+        self.assertEqual(storage.affected(['a.h']), [('app', None, None)])
+        storage.close()
+        self.assertEqual(sorted(os.listdir(self._path)), ['targets.db'])
+
+
+if __name__ == '__main__':
+    unittest.main()
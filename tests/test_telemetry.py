@@ -0,0 +1,88 @@
+import StringIO
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class TelemetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, '.biu')
+        os.mkdir(self._path)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _run(self, jobs=2):
+        """
+        Make a slow and a fast object, and a link of them.
+        """
+        slow, fast, link = [os.path.join(self._tmp, name)
+                            for name in ('slow.o', 'fast.o', 'link')]
+        executor = biubiu.Executor(jobs=jobs)
+        executor.add(slow, [], 'sleep 0.3 && touch slow.o', self._tmp)
+        executor.add(fast, [], 'touch fast.o', self._tmp)
+        executor.add(link, [slow, fast], 'sleep 0.1 && touch link',
+                     self._tmp)
+        self.assertTrue(executor.run())
+        biubiu.Telemetry(self._path).record(executor.graph(),
+                                            executor.timings(),
+                                            executor.stats())
+        return slow, fast, link
+
+    def test_record(self):
+        slow, fast, link = self._run()
+        telemetry = biubiu.Telemetry(self._path)
+        units = telemetry.slowest(10)
+        self.assertEqual([unit[0] for unit in units], [slow, fast])
+        self.assertGreaterEqual(units[0][1], 0.3)
+        self.assertEqual(telemetry.slowest(1), units[:1])
+        path = telemetry.critical_path()
+        self.assertEqual([target for target, _ in path], [link, slow])
+        self.assertGreaterEqual(path[0][1], 0.1)
+        stats = telemetry.stats()
+        self.assertEqual((stats['made'], stats['jobs']), (3, 2))
+        self.assertGreaterEqual(stats['busy'], 0.4)
+
+    def test_noop_run(self):
+        slow, _, _ = self._run()
+        telemetry = biubiu.Telemetry(self._path)
+        # Nothing is made, the timings and stats of the last run are kept.
+        telemetry.record({slow: []}, {}, {'made': 0})
+        telemetry = biubiu.Telemetry(self._path)
+        self.assertEqual(telemetry.stats()['made'], 3)
+        self.assertGreaterEqual(telemetry.slowest(1)[0][1], 0.3)
+
+    def test_report(self):
+        self._run()
+        options = collections.namedtuple('Options', 'top')(top=1)
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            os.chdir(self._tmp)
+            biubiu.BiuBiu().report(options)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+        self.assertIn('slow.o', output)
+        self.assertNotIn('fast.o', output)
+        lines = output.replace('\033[0m', '').splitlines()
+        critical = lines.index(
+            [line for line in lines if 'critical path' in line][0])
+        self.assertTrue(lines[critical + 1].endswith('slow.o'))
+        self.assertTrue(lines[critical + 2].endswith('link'))
+        self.assertIn('3 with 2 jobs', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = os.path.realpath(tempfile.mkdtemp())
+        self._watcher = biubiu.Watcher(biubiu.BiuBiu())
+
+    def tearDown(self):
+        self._watcher._inotify.close()
+        shutil.rmtree(self._tmp)
+
+    def _read(self):
+        events = []
+        while True:
+            batch = self._watcher._inotify.read(0.2)
+            if not batch:
+                return [path for path, _ in events]
+            events += batch
+
+    def test_recreated_dir(self):
+        src = os.path.join(self._tmp, 'src')
+        os.mkdir(src)
+        self._watcher._watch(self._tmp)
+        shutil.rmtree(src)
+        self._read()
+        # eg: `rm -rf src && git restore src`
+        os.mkdir(src)
+        self._read()
+        self._watcher._watch(self._tmp)
+        with open(os.path.join(src, 'a.cc'), 'w') as f:
+            f.write('int a;\n')
+        self.assertIn(os.path.join(src, 'a.cc'), self._read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import biubiu
+
+
+class WorkspacesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = os.path.realpath(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _write(self, path, content):
+        path = os.path.join(self._tmp, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _module(self, name, build):
+        self._write(os.path.join(name, 'BUILD'), build)
+        return os.path.join(self._tmp, name)
+
+    def test_diamond(self):
+        base = self._module('base', "LIBRARY('libbase.a', 'src/*.cc')\n")
+        left = self._module('left', "SUBMODULE(workspace='../base', "
+                            "libs=['libbase.a'])\n")
+        right = self._module('right', "SUBMODULE('../base', 'libbase.a')\n")
+        top = self._module('top', "CXXFLAGS('-O2')\n"
+                           "SUBMODULE(workspace='../left', libs='liba.a')\n"
+                           "SUBMODULE('../right', libs=['libb.a'])\n"
+                           "BINARY('app', sources=['src/*.cc'])\n")
+        order = biubiu.BiuBiu()._workspaces(top)
+        self.assertEqual(order.keys(), [base, left, right, top])
+        self.assertEqual(order[top], [left, right])
+        self.assertEqual(order[base], [])
+
+    def test_generate(self):
+        sub = self._module('sub', "LIBRARY('libsub.a', sources='src/*.cc')\n")
+        top = self._module('top', "SUBMODULE(workspace='../sub', "
+                           "libs='lib/libsub.a')\n"
+                           "BINARY('app', includes=['src/'], "
+                           "sources=['src/*.cc'])\n")
+        self._write('sub/src/sub.cc', 'int sub() { return 0; }\n')
+        self._write('top/src/foo.h', '#pragma once\n')
+        self._write('top/src/main.cc', '#include "foo.h"\nint main() {}\n')
+        pwd = os.getcwd()
+        os.chdir(top)
+        try:
+            modules = biubiu.BiuBiu().generate()
+            self.assertEqual(os.getcwd(), top)
+        finally:
+            os.chdir(pwd)
+        self.assertEqual([module.workspace() for module in modules],
+                         [top, sub])
+        with open(os.path.join(top, 'Makefile')) as f:
+            makefile = f.read()
+        self.assertIn('src/main.cc \\\n\tsrc/foo.h', makefile)
+        self.assertIn('make -C ' + sub, makefile)
+        self.assertTrue(os.path.exists(os.path.join(sub, 'Makefile')))
+
+    def test_generate_module(self):
+        # Generates a submodule from another directory without changing it.
+        sub = self._module('sub', "LIBRARY('libsub.a', sources='src/*.cc')\n")
+        self._write('sub/src/sub.cc', 'int sub() { return 0; }\n')
+        pwd = os.getcwd()
+        graphs = {}
+        module, _ = biubiu.generate_module(
+            (biubiu.BiuBiu(), sub, 'make', 1, False), graphs)
+        self.assertEqual(os.getcwd(), pwd)
+        self.assertEqual(module.workspace(), sub)
+        self.assertEqual(graphs.keys(), [sub])
+        graphs[sub].close()
+        with open(os.path.join(sub, 'Makefile')) as f:
+            self.assertIn('output/sub/objs/libsub.a/src/sub.cc.o : '
+                          'src/sub.cc', f.read())
+
+    def _generate(self, top, generator='make'):
+        pwd = os.getcwd()
+        os.chdir(top)
+        try:
+            return biubiu.BiuBiu().generate(generator=generator)
+        finally:
+            os.chdir(pwd)
+
+    def test_flat(self):
+        # A single Makefile includes the rules of every module once, even
+        # for a SUBMODULE shared by a diamond.
+        base = self._module('base', "LIBRARY('libbase.a', 'src/*.cc')\n")
+        for name in ('left', 'right'):
+            self._module(name, "SUBMODULE('../base', 'lib/libbase.a')\n"
+                         "LIBRARY('lib%s.a', 'src/*.cc')\n" % name)
+        top = self._module('top', "SUBMODULE('../left', 'lib/libleft.a')\n"
+                           "SUBMODULE('../right', 'lib/libright.a')\n"
+                           "BINARY('app', sources=['src/*.cc'])\n")
+        self._write('base/src/base.cc', 'int base() { return 0; }\n')
+        for name in ('left', 'right'):
+            self._write('%s/src/%s.cc' % (name, name),
+                        'int %s() { return 0; }\n' % name)
+        self._write('top/src/main.cc', 'int left();\nint right();\n'
+                    'int main() { return left() + right(); }\n')
+        modules = self._generate(top, 'flat')
+        self.assertEqual(len(modules), 4)
+        with open(os.path.join(top, 'Makefile')) as f:
+            makefile = f.read()
+        for name in ('base', 'left', 'right'):
+            fragment = os.path.join(self._tmp, name, '.biu', 'rules.mk')
+            self.assertEqual(makefile.count('include %s\n' % fragment), 1)
+        self.assertNotIn('make -C', makefile)
+        with open(os.path.join(base, '.biu', 'rules.mk')) as f:
+            rules = f.read()
+        self.assertIn('%s/output/base/objs/libbase.a/src/base.cc.o : '
+                      '%s/src/base.cc' % (base, base), rules)
+        self.assertIn('cd %s && ' % base, rules)
+        subprocess.check_output(['make'], cwd=top, stderr=subprocess.STDOUT)
+        for path in ('top/output/top/bin/app',
+                     'base/output/base/lib/libbase.a'):
+            self.assertTrue(os.path.exists(os.path.join(self._tmp, path)))
+        # Everything is made by the single graph, nothing is left behind.
+        output = subprocess.check_output(['make', '-n'], cwd=top,
+                                         stderr=subprocess.STDOUT)
+        self.assertNotIn('g++', output)
+
+    @unittest.skipUnless(find_executable('ninja'), 'ninja is not found')
+    def test_ninja_pch(self):
+        # The subninja of a submodule runs in the top workspace.
+        self._module('sub', "PCH(['src/common.h'])\n"
+                     "LIBRARY('libsub.a', includes=['src/'], "
+                     "sources=['src/*.cc'])\n")
+        top = self._module('top', "SUBMODULE('../sub', 'lib/libsub.a')\n"
+                           "BINARY('app', sources=['src/*.cc'])\n")
+        self._write('sub/src/common.h', 'int common();\n')
+        for name in 'ab':
+            self._write('sub/src/%s.cc' % name, '#include "common.h"\n'
+                        'int %s() { return common(); }\n' % name)
+        self._write('sub/src/common.cc', 'int common() { return 0; }\n')
+        self._write('top/src/main.cc', 'int main() {}\n')
+        self._generate(top, 'ninja')
+        with open(os.path.join(self._tmp, 'sub', 'build.ninja')) as f:
+            self.assertIn('-include %s/sub/output/sub/pch/' % self._tmp,
+                          f.read())
+        subprocess.check_output(['ninja'], cwd=top, stderr=subprocess.STDOUT)
+        self.assertTrue(os.path.exists(
+            os.path.join(top, 'output', 'top', 'bin', 'app')))
+
+    @unittest.skipUnless(find_executable('ninja'), 'ninja is not found')
+    def test_ninja(self):
+        # The relative paths in flags of a submodule are rebased as well.
+        self._module('sub', "CXXFLAGS('-I inc')\n"
+                     "LDFLAGS('-L.')\n"
+                     "LIBRARY('libsub.a', sources=['src/sub.cc'])\n"
+                     "BINARY('tool', sources=['src/tool.cc'], "
+                     "ldlibs=['-lext'])\n")
+        top = self._module('top', "SUBMODULE('../sub', 'lib/libsub.a')\n"
+                           "BINARY('app', sources=['src/*.cc'])\n")
+        self._write('sub/inc/ext.h', 'int ext();\n')
+        self._write('sub/ext.cc', 'int ext() { return 0; }\n')
+        self._write('sub/src/sub.cc', 'int sub() { return 0; }\n')
+        self._write('sub/src/tool.cc',
+                    '#include <ext.h>\nint main() { return ext(); }\n')
+        self._write('top/src/main.cc',
+                    'int sub();\nint main() { return sub(); }\n')
+        sub = os.path.join(self._tmp, 'sub')
+        subprocess.check_call('g++ -c ext.cc && ar rcs libext.a ext.o',
+                              shell=True, cwd=sub)
+        self._generate(top, 'ninja')
+        with open(os.path.join(top, 'build.ninja')) as f:
+            self.assertIn('subninja %s/build.ninja' % sub, f.read())
+        subprocess.check_output(['ninja', 'all', 'sub'], cwd=top,
+                                stderr=subprocess.STDOUT)
+        for path in ('top/output/top/bin/app', 'sub/output/sub/bin/tool'):
+            self.assertTrue(os.path.exists(os.path.join(self._tmp, path)))
+
+
+if __name__ == '__main__':
+    unittest.main()